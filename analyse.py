@@ -1,164 +1,600 @@
 import os
 import sys
 import json
-import glob
+import csv
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
+import io
+import itertools
 import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 import plotly.express as px
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+
 from common import Common
+from output_sink import CsvSink
+from result_cache import ResultCache
+from sidecar import ColumnarSidecar
+from file_discovery import FileDiscovery, FILENAME_TIMESTAMP_REGEX, FILENAME_TIMESTAMP_FORMAT
+from time_index import TimeIndex, ByteRange
+from follow_state import FollowState
+from shard_coordinator import ShardCoordinator
+from row_dedup import RowKeySet, row_keys
+from compressed_input import is_compressed, open_text, csv_source, input_size
+from report import AnomalyReport, sample_points, merge_points
+from memory_lean import filename_column, compact_frame, align_dtypes, expand_frame
+from detectors import compile_detectors, DetectorError
+from episodes import find_episodes, merge_episodes, episode_table
+from rule_engine import compile_rules, RuleError
+from state_change import compile_state_changes, merge_transitions, StateChangeError
+from metrics import (start_timer, add_stage, merge_stages, with_rates, process_peak_rss_mb, process_cpu_seconds,
+                     write_metrics, profile_call)
+
+# output csvs of a run, appended to the output file prefix
+OUTPUT_SUFFIXES = {"threshold": "_threshold.csv",
+                   "state_change": "_state_toggle.csv",
+                   "threshold_detailed": "_threshold_detailed.csv",
+                   "threshold_episodes": "_threshold_episodes.csv",
+                   "state_change_detailed": "_state_toggle_detailed.csv",
+                   "detector": "_detector.csv",
+                   "detector_detailed": "_detector_detailed.csv"}
+
+# analyser instance owned by a worker process of the pool used in find_abnormalities
+_worker_analyser = None
+
+
+def _init_worker(analyser):
+    global _worker_analyser
+    _worker_analyser = analyser
+    # no-op when the worker is forked from an already configured parent
+    analyser.set_logging(analyser.outdir, analyser.loglevel)
+
+
+def _analyse_file_worker(cf):
+    return _worker_analyser.analyse_file(cf)
+
 
 class AnalyseData(Common):
 
     
-    def __init__(self, input_json, loglevel):
+    def __init__(self, input_json, loglevel, workers=None, logger_name=None):
         self.starttimestamp = time.time()
         Common.__init__(self)
         jsondata = self.read_inputjson(input_json)
+        self.jsondata = jsondata
         self.outdir, outbase = self.setup_output_directory(jsondata["output_directory"])
         shutil.copy(input_json, os.path.join(self.outdir, os.path.basename(input_json)))
         self.outfile = os.path.join(self.outdir, outbase + "_" + self.current_datetime)
 
-        self.set_logging(self.outdir, loglevel)
+        self.loglevel = loglevel
+        if logger_name:
+            #own logger and log file when several input jsons are analysed in one run
+            self.logger = logging.getLogger(logger_name)
+            self.add_log_file()
+        else:
+            self.set_logging(self.outdir, loglevel)
         self.cols_to_print = list([" "])
         self.threshold_cross = jsondata.get("threshold", None)
         self.state_change = jsondata.get("state_change", None)
         self.extra_columns = set(jsondata.get("extra_columns", list()))
         self.create_detailed_csv = jsondata.get("create_detailed_csv", None)
+        #one row per run of threshold crossings, runs with at most episode_max_gap rows between them are joined
+        self.create_episodes = jsondata.get("create_episodes", False)
+        self.episode_max_gap = jsondata.get("episode_max_gap", 0)
         self.rowsbefore = jsondata.get("rows_before_abnormality", 0)
         self.rowsafter = jsondata.get("rows_after_abnormality", 0)
         #default to skip 4 rows
         self.skiprows = jsondata.get("header_start_row", 4)
+        #number of rows read from a csv at a time, 0 reads whole files
+        self.chunk_size = jsondata.get("chunk_size", 0)
+        #parser used for csv files: c, python or pyarrow (multithreaded, whole files only)
+        self.csv_engine = jsondata.get("csv_engine", "c")
+        if self.csv_engine not in ["c", "python", "pyarrow"]:
+            self.logger.error(f"Invalid csv_engine {self.csv_engine}, use c, python or pyarrow")
+            sys.exit(-1)
+        if self.csv_engine == "pyarrow" and pacsv is None:
+            self.logger.error("pyarrow is not installed, using the c engine")
+            self.csv_engine = "c"
+        if self.csv_engine == "pyarrow" and self.chunk_size:
+            self.logger.warning("csv_engine pyarrow does not read in chunks, using the c engine with chunk_size")
+        #read threshold columns as float64 instead of converting them after parsing. A file with values
+        #that are not numbers in them is read again with these columns as text, the values become NaN
+        self.typed_columns = jsondata.get("typed_columns", False)
+        #categorical filename column and downcast numeric columns, outputs are written with the usual types
+        self.memory_lean = jsondata.get("memory_lean", False)
+        self.bool_columns = set()
+        #number of processes used to analyse files, 1 runs serially in this process
+        self.workers = workers if workers is not None else jsondata.get("workers", 1)
+        if self.workers < 1:
+            self.workers = os.cpu_count() or 1
         self.stats = ""
         self.total_toggles = 0
+        self.transitions = dict()
+        #wall/cpu seconds and rows per stage over the run, parse/threshold/state_change are summed over worker processes
+        self.stage_times = dict()
+        self.timings = dict()
+        self.file_metrics = list()
+        #rows matching the threshold rules and rows written to the threshold output with the rows around them
+        self.threshold_rows = {"matched": 0, "output": 0}
+        #profile analysing one file (file name or path) with cProfile, and tracemalloc with profile_memory
+        self.profile_file = jsondata.get("profile_file", "")
+        self.profile_memory = jsondata.get("profile_memory", False)
         self.threshold_column_of_interest_list = list()
 
+        #columnar copies of the input csvs, later runs read only the needed columns from them
+        self.sidecar = None
+        if jsondata.get("sidecar_directory", None):
+            self.sidecar = ColumnarSidecar(jsondata["sidecar_directory"],
+                                           jsondata.get("sidecar_format", "parquet"),
+                                           self.skiprows)
+
+        #first and last Local Computer Time of each file, used to skip files and rows outside
+        #start_date/end_date or number_of_days instead of the file modification times
+        self.time_index = None
+        self.time_window = None
+        if jsondata.get("time_index_file", None):
+            self.time_index = TimeIndex(jsondata["time_index_file"], self.read_header,
+                                        workers=jsondata.get("discovery_workers", 8))
+            if jsondata.get("start_date", None):
+                self.time_window = self.construct_datatime_from_input(jsondata.get("start_time", None),
+                                                                      jsondata["start_date"],
+                                                                      jsondata.get("end_time", None),
+                                                                      jsondata.get("end_date", None))
+            elif jsondata.get("number_of_days", None):
+                # whole days, so the window and the result cache key stay the same during a day
+                today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                self.time_window = (today - timedelta(days=jsondata["number_of_days"] + 1), today + timedelta(days=1))
+
+        #byte offsets and carried rows of the files followed with --follow, kept between runs
+        self.follow_state_file = jsondata.get("follow_state_file", None) or (jsondata["output_directory"] + "_follow_state.pkl")
+
+        #shared directory through which workers on several hosts split the files with --shard
+        self.shard_directory = jsondata.get("shard_directory", "")
+        self.shard_size = jsondata.get("shard_size", 10)
+        self.lease_timeout = jsondata.get("lease_timeout", 600)
+
+        #per file results kept between runs, only files that are new or modified are read again
+        self.result_cache = None
+        if jsondata.get("cache_directory", None):
+            rule_config = {key: jsondata.get(key, None) for key in
+                           ["threshold", "state_change", "header_start_row", "create_detailed_csv",
+                            "rows_before_abnormality", "rows_after_abnormality",
+                            "create_report", "report_points", "report_max_anomaly_points", "detectors",
+                            "create_episodes", "episode_max_gap", "memory_lean"]}
+            rule_config["extra_columns"] = sorted(self.extra_columns)
+            if self.time_window:
+                rule_config["time_window"] = [x.isoformat() for x in self.time_window]
+            self.result_cache = ResultCache(jsondata["cache_directory"], rule_config,
+                                            jsondata.get("cache_max_size_mb", 1024))
+
+        #rows repeated within or across files (same Local Computer Time and values, e.g. overlapping
+        #exports) are dropped before they are analysed. Files are then analysed in order in one process
+        self.row_dedup = None
+        if jsondata.get("dedupe_rows", False):
+            self.row_dedup = RowKeySet(jsondata.get("dedupe_max_keys", 100000000),
+                                       jsondata.get("dedupe_spill_directory", None))
+            if self.result_cache:
+                self.logger.warning("cache_directory is not used with dedupe_rows, results depend on the files read before")
+                self.result_cache = None
+            if self.workers > 1:
+                self.logger.warning("dedupe_rows analyses the files in input order in one process")
+
+        self.threshold_rules = None
         if self.threshold_cross:
-            for entry in self.threshold_cross:
-                self.threshold_column_of_interest_list.append(entry.get("column_of_interest", ""))
-                #self.threshold = entry.get("value", None)
-                self.operator = entry.get("operator", "=")
-                 #validate operator- from
-                if not any(x != self.operator for x in [">", "<","<=",">=","="]):
-                    self.logger.error("Invalid operator")
-                    sys.exit(-1)
-                #self.logger.info(f"Finding threshold value {self.threshold} crossing in {self.threshold_column_of_interest}")
+            try:
+                self.threshold_rules = compile_rules(self.threshold_cross)
+            except RuleError as e:
+                self.logger.error(f"Invalid threshold: {e}")
+                sys.exit(-1)
+        if self.threshold_rules:
+            self.threshold_column_of_interest_list = list(dict.fromkeys(self.threshold_rules.columns()))
+            self.logger.info(f"Finding threshold crossing for expression: {self.threshold_rules.expression()}")
 
+        self.state_changes = list()
         if self.state_change:
-            self.state_change_column_of_interest = self.state_change.get("column_of_interest", None)
-            self.state_change_value1 = self.state_change.get("value_1", None)
-            self.state_change_value2 = self.state_change.get("value_2", None)
-            self.logger.info(f"Finding state change for column: {self.state_change_column_of_interest}")
+            try:
+                self.state_changes = compile_state_changes(self.state_change)
+            except StateChangeError as e:
+                self.logger.error(f"Invalid state_change: {e}")
+                sys.exit(-1)
+            for spec in self.state_changes:
+                self.logger.info(f"Finding state change for column: {spec.description()}")
+        self.state_change_column_list = list(dict.fromkeys(spec.column for spec in self.state_changes))
 
-        self.load_columns_from_csv = ([self.state_change_column_of_interest] +
+        #rolling z-score, rate of change and stuck value detectors
+        try:
+            self.detectors = compile_detectors(jsondata.get("detectors", list()))
+        except DetectorError as e:
+            self.logger.error(f"Invalid detectors: {e}")
+            sys.exit(-1)
+        for detector in self.detectors:
+            self.logger.info(f"Finding {detector.name}")
+        self.detector_column_list = list(dict.fromkeys(detector.column for detector in self.detectors))
+        #rows carried over between chunks: the rows before abnormalities and the rows the detectors look back on
+        self.lookback = max([self.rowsbefore] + [detector.lookback for detector in self.detectors])
+
+        self.columns_of_interest = [col for col in self.threshold_column_of_interest_list +
+                                    self.state_change_column_list + self.detector_column_list if col]
+
+        #html report with downsampled figures of the columns of interest and the first rows of the outputs
+        self.report = None
+        if jsondata.get("create_report", False):
+            self.report = AnomalyReport(self.outfile + "_report.html",
+                                        jsondata.get("report_points", 2000),
+                                        jsondata.get("report_max_anomaly_points", 5000),
+                                        jsondata.get("report_table_rows", 100),
+                                        self.workers)
+        self.load_columns_from_csv = (self.state_change_column_list +
                                       list(self.extra_columns) +
                                       self.threshold_column_of_interest_list +
+                                      self.detector_column_list +
                                       ["Local Computer Time"])
 
 
-    def call_analysis(self, input_json):
-        jdata = self.read_inputjson(input_json)
-        allcsvs = self.get_files(jdata)
+    def add_log_file(self):
+        if not any(isinstance(handler, logging.FileHandler) for handler in self.logger.handlers):
+            handler = logging.FileHandler(os.path.join(self.outdir, "log_" + format(self.current_datetime)))
+            handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+            self.logger.addHandler(handler)
+        self.logger.setLevel(self.loglevel)
+
+    def call_analysis(self):
+        start = start_timer()
+        allcsvs = self.get_files(self.jsondata)
+        add_stage(self.stage_times, "discovery", start, rows=len(allcsvs or list()))
         self.logger.info(allcsvs)
 
         if allcsvs:
-            self.find_abnormalities(allcsvs, jdata)
-    
+            self.find_abnormalities(allcsvs)
+        else:
+            self.save_metrics()
+
     def check_index(self, dffilter, maindf):
-        dfchecked = pd.DataFrame()
-        if not dffilter.empty:
-            if self.rowsbefore and self.rowsafter:
-                st = dffilter.index
-                for idx in st:
-                    start_idx = max(0, idx - self.rowsbefore)
-                    end_idx = min(maindf.shape[0], idx + self.rowsafter)
-                    dfchecked = pd.concat([dfchecked, maindf.loc[start_idx:end_idx]], axis=0).drop_duplicates()
-            else:
-                dfchecked = pd.concat([dfchecked, dffilter], axis=0).drop_duplicates()
-                
-        return dfchecked
-
-    def check_index_state_change(self, dfs, maindf):
-        dftog = pd.DataFrame()
-        if not dfs.empty:
-            if self.rowsbefore and self.rowsafter:
-                st = dfs.index
-                for idx in st:
-                    start_idx = max(0, idx - self.rowsbefore)
-                    end_idx = min(maindf.shape[0], idx + self.rowsafter)
-                    dftog = pd.concat([dftog, maindf.loc[start_idx:end_idx]], axis=0).drop_duplicates()
+        if dffilter.empty:
+            return pd.DataFrame()
+        if not (self.rowsbefore or self.rowsafter):
+            return dffilter.drop_duplicates()
+
+        # mark the union of [hit - rowsbefore, hit + rowsafter] ranges with a difference array:
+        # +1 where a range starts, -1 after it ends, rows with a positive running sum are selected
+        hits = maindf.index.get_indexer(dffilter.index)
+        nrows = maindf.shape[0]
+        delta = np.zeros(nrows + 1, dtype=np.int64)
+        np.add.at(delta, np.maximum(hits - self.rowsbefore, 0), 1)
+        np.add.at(delta, np.minimum(hits + self.rowsafter + 1, nrows), -1)
+        return maindf[np.cumsum(delta[:-1]) > 0].drop_duplicates()
+
+    def rows_in_range(self, df, hit_range):
+        return df[(df.index >= hit_range[0]) & (df.index <= hit_range[1])]
+
+    def threshold_expression(self, columns, fname):
+        # rule tree for the columns present in the file
+        self.threshold_columns = list()
+        if not self.threshold_rules:
+            return None
+
+        for col in self.threshold_column_of_interest_list:
+            if col not in columns:
+                self.logger.info(f"Threshold column: {col} not found in {fname}")
+                if col in self.cols_to_print:
+                    self.cols_to_print.remove(col)
             else:
-                dftog = pd.concat([dftog, dfs], axis=0).drop_duplicates()
-        return dftog
+                if col not in self.cols_to_print:
+                    self.cols_to_print.append(col)
+                self.threshold_columns.append(col)
 
-    def analyse_threshold(self, dft, fname):
-        dfall_local = pd.DataFrame()
-        exprlist = list()
+        rules = self.threshold_rules.bind(columns)
+        if rules is None and self.threshold_columns:
+            self.logger.info(f"No threshold rule can match in {fname}, the rules need columns missing from it")
+        return rules
 
-        if bool(self.threshold_cross):
-            for entry in self.threshold_cross:
-                if entry["column_of_interest"] == "":
-                    continue
+    def state_change_specs(self, columns, fname):
+        # state changes for the columns present in the file
+        for col in self.state_change_column_list:
+            if col not in columns:
+                self.logger.info(f"State change column: {col} not found in {fname}")
+                if col in self.cols_to_print:
+                    self.cols_to_print.remove(col)
+            elif col not in self.cols_to_print:
+                self.cols_to_print.append(col)
+        return [spec for spec in self.state_changes if spec.column in columns]
+
+    def analyse_threshold(self, dft, rules, hit_range):
+        for col in self.threshold_columns:
+            # Convert the column to numeric values (ignoring errors)
+            if not is_numeric_dtype(dft[col]):
+                dft[col] = pd.to_numeric(dft[col], errors='coerce')
+        masks = dict()
+        in_range = (dft.index >= hit_range[0]) & (dft.index <= hit_range[1])
+        hit = rules.evaluate(dft, masks) & in_range
+        dfc = dft[hit]
+        rule_hits = {name: int((mask & in_range).sum()) for name, mask in masks.items()}
+        # the matched rows of each rule or "not" that makes rows match, they add up to hit
+        hit_masks = {matcher.name: masks[matcher.name] & hit for matcher in rules.matchers()}
+        return self.check_index(dfc, dft), dfc, rule_hits, hit, hit_masks
+
+    def analyse_state_change(self, dfs, specs, hit_range):
+        in_range = (dfs.index >= hit_range[0]) & (dfs.index <= hit_range[1])
+        mask = np.zeros(dfs.shape[0], dtype=bool)
+        transitions = dict()
+        for spec in specs:
+            spec_mask, counts = spec.detect(dfs[spec.column], in_range)
+            mask |= spec_mask
+            merge_transitions(transitions, {spec.column: counts})
+        return self.check_index(dfs[mask & in_range], dfs), transitions
+
+    def analyse_detectors(self, dfd, detectors, hit_range):
+        in_range = (dfd.index >= hit_range[0]) & (dfd.index <= hit_range[1])
+        mask = np.zeros(dfd.shape[0], dtype=bool)
+        detector_hits = dict()
+        for detector in detectors:
+            values = pd.to_numeric(dfd[detector.column], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+            detected = detector.detect(values)
+            detector_hits[detector.name] = int((detected & in_range).sum())
+            mask |= detected
+        dfc = dfd[mask & in_range]
+        return self.check_index(dfc, dfd), dfc.shape[0], detector_hits
+
+    def read_header(self, cf):
+        # returns the number of lines before the header line and the column names in it
+        with open_text(cf) as f:
+            skipped = self.skiprows
+            for _ in range(self.skiprows):
+                f.readline()
+            # read_csv skips blank lines before the header as well
+            line = f.readline()
+            while line and not line.strip():
+                skipped += 1
+                line = f.readline()
+        return skipped, next(csv.reader([line]), list())
 
-                if entry["column_of_interest"] not in dft.columns:
-                    self.logger.info(f"Threshold column: {entry['column_of_interest']} not found in {fname}")
-                    if entry["column_of_interest"] in self.cols_to_print:
-                        self.cols_to_print.remove(entry["column_of_interest"])
-                else:
-                    if entry["column_of_interest"] not in self.cols_to_print:
-                        self.cols_to_print.append(entry["column_of_interest"])
-                    # Convert the column to numeric values (ignoring errors)
-                    dft[entry["column_of_interest"]] = pd.to_numeric(dft[entry["column_of_interest"]], errors='coerce')
-                    # Filter based on the threshold
-                    exprlist.append(f"`{entry['column_of_interest']}` {entry['operator']} {entry['value']}")
-
-            if exprlist:
-                expr = " | ".join(x for x in exprlist)
-                dfc = dft.query(expr)
-                if dfc.empty:
-                    self.logger.info(f"Does not exceed threshold in file {fname}")
-                else:
-                    # TODO: check if either of rows before or after exist
-                    # self.check_index(df, rowsbefore, rowsafter, self.threshold_column_of_interest, cf)
-                    self.logger.info(f"Threshold crossed {dfc.shape[0]} times in file {fname} for expression {expr}")
-                    self.stats += f"Threshold crossed {dfc.shape[0]} times in file {fname} for expression {expr}<br>"
-
-                    dfall_local = self.check_index(dfc, dft)
-            return dfall_local
-
-
-
-    def analyse_state_change(self, dfs, fname):
-        dftoggle = pd.DataFrame()
-        if bool(self.state_change):
-            if self.state_change_column_of_interest == "":
-                return dftoggle
-            if self.state_change_column_of_interest not in dfs.columns:
-                self.logger.info(f"State change column: {self.state_change_column_of_interest} not found in {fname}")
-                if self.state_change_column_of_interest in self.cols_to_print:
-                    self.cols_to_print.remove(self.state_change_column_of_interest)
-                return dftoggle
+    def column_dtypes(self, usecols):
+        dtypes = {"Local Computer Time": "str"}
+        if self.typed_columns:
+            for col in self.threshold_column_of_interest_list:
+                dtypes[col] = "float64"
+        return {col: dtype for col, dtype in dtypes.items() if col in usecols}
+
+    def read_chunks(self, cf, usecols, byte_range=None):
+        reader = None
+        if byte_range:
+            reader = self.typed_chunks(cf, lambda d: self.read_csv_range(cf, usecols, byte_range, d),
+                                       self.column_dtypes(usecols))
+        if reader is None and self.sidecar:
+            # the sidecar does not depend on the rules, only the time column is read with a set type.
+            # With typed_columns the threshold columns are converted when they are read from it
+            _, header = self.read_header(cf)
+            reader = self.sidecar.read_chunks(cf, usecols, self.chunk_size,
+                                              {col: "str" for col in ["Local Computer Time"] if col in header})
+            if reader is not None and self.typed_columns:
+                reader = self.numeric_chunks(reader, [col for col, dtype in self.column_dtypes(usecols).items()
+                                                      if dtype == "float64"])
+        if reader is None:
+            reader = self.read_csv_chunks(cf, usecols)
+        rows = {"next_row": None, "dropped": 0}
+        for chunk in reader:
+            if self.row_dedup:
+                chunk = self.dedupe_rows(chunk, rows)
+            if self.memory_lean:
+                self.bool_columns.update(compact_frame(chunk))
+                chunk.insert(0, "filename", filename_column(cf, chunk.shape[0]))
             else:
-                self.cols_to_print.append(self.state_change_column_of_interest)
-                if is_numeric_dtype(dfs[self.state_change_column_of_interest]):
-                    self.state_change_value2 = float(self.state_change_value2)
-                    self.state_change_value1 = float(self.state_change_value1)
-                dfs['shifted'] = dfs[self.state_change_column_of_interest].shift(fill_value=None)
-                df1 = dfs[(dfs.shifted == self.state_change_value1) & (dfs[self.state_change_column_of_interest] == self.state_change_value2)]
-                df2 = dfs[(dfs.shifted == self.state_change_value2) & (dfs[self.state_change_column_of_interest] == self.state_change_value1)]
-                #TODO: check if either of rows before or after exist
-                dftoggle1 = self.check_index(df1, dfs)
-                dftoggle2 = self.check_index(df2, dfs)
-                dftoggle = pd.concat([dftoggle1, dftoggle2], axis=0).drop_duplicates()
-
-                self.logger.info(f"Number of times state change from {self.state_change_value1} to {self.state_change_value2} : {df1.shape[0]}")
-                self.logger.info(f"---Number of times state change from {self.state_change_value2} to {self.state_change_value1} : {df2.shape[0]}")
-                self.total_toggles += df1.shape[0] + df2.shape[0]
-                return dftoggle
+                chunk.insert(0, "filename", cf)
+            yield chunk
+        if self.row_dedup:
+            self.logger.info(f"Dropped {rows['dropped']} repeated rows of {cf}")
+
+    def dedupe_rows(self, chunk, rows):
+        # rows not seen before in this or earlier files, numbered without the dropped rows
+        start = start_timer()
+        keep = self.row_dedup.add(row_keys(chunk))
+        dropped = chunk.shape[0] - int(keep.sum())
+        if rows["next_row"] is None:
+            rows["next_row"] = chunk.index[0] if chunk.shape[0] else 0
+        if dropped:
+            chunk = chunk[keep]
+        chunk.index = pd.RangeIndex(rows["next_row"], rows["next_row"] + chunk.shape[0])
+        rows["next_row"] += chunk.shape[0]
+        rows["dropped"] += dropped
+        add_stage(self.timings, "dedupe", start, rows=keep.shape[0], matched=dropped)
+        return chunk
+
+    def typed_chunks(self, cf, read, dtypes):
+        # read(dtypes) gives the chunks of cf. When a threshold column read as float64 has a value that is
+        # not a number, the chunks are read again with the threshold columns as text and converted to
+        # numbers with such values as NaN. The chunks given before the failing one are not given again
+        typed = [col for col, dtype in dtypes.items() if dtype == "float64"]
+        given = 0
+        try:
+            for chunk in read(dtypes):
+                yield chunk
+                given += 1
+            return
+        except ValueError as e:
+            if not typed or isinstance(e, pd.errors.ParserError):
+                raise
+            self.logger.warning(f"Threshold columns of {cf} have values that are not numbers, "
+                                f"they are read as missing values: {e}")
+        text = {col: dtype for col, dtype in dtypes.items() if col not in typed}
+        chunks = read({**text, **{col: "str" for col in typed}})
+        yield from self.numeric_chunks(itertools.islice(chunks, given, None), typed)
+
+    def numeric_chunks(self, chunks, columns):
+        # the columns as float64, values that are not numbers become NaN
+        for chunk in chunks:
+            for col in columns:
+                if chunk[col].dtype != "float64":
+                    chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("float64")
+            yield chunk
+
+    def read_csv_chunks(self, cf, usecols):
+        dtypes = self.column_dtypes(usecols)
+        if self.csv_engine == "pyarrow" and not self.chunk_size:
+            df = None
+            try:
+                df = next(self.typed_chunks(cf, lambda d: [self.read_csv_pyarrow(cf, usecols, d)], dtypes))
+            except Exception as e:
+                self.logger.warning(f"pyarrow could not parse {cf}, using the c engine: {e}")
+            if df is not None:
+                yield df
+                return
+        yield from self.typed_chunks(cf, lambda d: self.read_csv_source(cf, usecols, d), dtypes)
+
+    def read_csv_source(self, cf, usecols, dtypes):
+        engine = "python" if self.csv_engine == "python" else "c"
+        options = dict(low_memory=False) if engine == "c" else dict()
+        # compressed files and zip members are decompressed while they are parsed, without temporary files
+        with csv_source(cf) as source:
+            reader = pd.read_csv(source,
+                                 skiprows=self.skiprows,
+                                 usecols=usecols,
+                                 dtype=dtypes,
+                                 engine=engine,
+                                 chunksize=self.chunk_size or None,
+                                 **options)
+            if not self.chunk_size:
+                yield reader
+                return
+            yield from reader
+
+    def read_csv_range(self, cf, usecols, byte_range, dtypes):
+        # rows between the byte offsets found in the time index, the header line is not part of them
+        # and the range is streamed, only a chunk of it is in memory at a time
+        _, header = self.read_header(cf)
+        engine = "python" if self.csv_engine == "python" else "c"
+        options = dict(low_memory=False) if engine == "c" else dict()
+        with open(cf, "rb") as f:
+            reader = pd.read_csv(io.BufferedReader(ByteRange(f, *byte_range)),
+                                 header=None,
+                                 names=header,
+                                 usecols=usecols,
+                                 dtype=dtypes,
+                                 engine=engine,
+                                 chunksize=self.chunk_size or None,
+                                 **options)
+            if not self.chunk_size:
+                yield reader
+                return
+            yield from reader
+
+    def read_csv_pyarrow(self, cf, usecols, dtypes):
+        # multithreaded parse, the header line found by read_header is skipped and named explicitly
+        skipped, header = self.read_header(cf)
+        with csv_source(cf) as source:
+            table = pacsv.read_csv(source,
+                                   read_options=pacsv.ReadOptions(skip_rows=skipped + 1, column_names=header),
+                                   convert_options=pacsv.ConvertOptions(
+                                       include_columns=usecols,
+                                       column_types={col: pa.string() if dtype == "str" else pa.float64()
+                                                     for col, dtype in dtypes.items()}))
+        return table.to_pandas()
+
+    def scan_chunks(self, chunk, chunks, rules, sc_specs, carry=None, pending=0, final=True, detectors=None):
+        # Each chunk is analysed together with rows carried over from the previous one:
+        # rows_before_abnormality rows (plus one for the shift comparison) in front of the rows not
+        # analysed yet, and the last rows_after_abnormality rows, which are only analysed once the
+        # next chunk provides the rows after them. Unless final, the last rows_after_abnormality rows
+        # of the last chunk are left in the returned carry for the rows appended later.
+        # Detectors look back on up to lookback rows, which are carried over as well.
+        scan = {"threshold": list(), "threshold_hits": 0, "rule_hits": dict(), "episodes": list(),
+                "state_change": list(), "transitions": dict(),
+                "detector": list(), "detector_hits": 0, "detector_rule_hits": dict(),
+                "report_series": dict(), "report_anomalies": dict(), "report_anomaly_counts": dict()}
+        while chunk is not None:
+            start = start_timer()
+            nxt = next(chunks, None)
+            add_stage(self.timings, "parse", start, rows=0 if nxt is None else nxt.shape[0])
+            if carry is not None and self.memory_lean:
+                carry, chunk = align_dtypes(carry, chunk)
+            frame = chunk if carry is None else pd.concat([carry, chunk], axis=0)
+            if not frame.empty:
+                last = frame.index[-1] if nxt is None and final else frame.index[-1] - self.rowsafter
+                hit_range = (pending, last)
+                nrows = max(last + 1 - pending, 0)
+                if rules:
+                    start = start_timer()
+                    dfr, hits, rule_hits, hit, hit_masks = self.analyse_threshold(frame, rules, hit_range)
+                    scan["threshold"].append(dfr)
+                    scan["threshold_hits"] += hits.shape[0]
+                    for name, count in rule_hits.items():
+                        scan["rule_hits"][name] = scan["rule_hits"].get(name, 0) + count
+                    add_stage(self.timings, "threshold", start, rows=nrows, matched=hits.shape[0])
+                    if self.create_episodes:
+                        start = start_timer()
+                        scan["episodes"].append(find_episodes(frame, hit, hit_masks, rules.columns(), self.episode_max_gap))
+                        add_stage(self.timings, "episodes", start, rows=hits.shape[0], matched=scan["episodes"][-1].shape[0])
+                    if self.report:
+                        self.sample_anomalies(scan, frame, rules, hit, hit_masks)
+                if sc_specs:
+                    start = start_timer()
+                    dftoggle, transitions = self.analyse_state_change(frame, sc_specs, hit_range)
+                    scan["state_change"].append(dftoggle)
+                    merge_transitions(scan["transitions"], transitions)
+                    add_stage(self.timings, "state_change", start, rows=nrows,
+                              matched=sum(sum(counts.values()) for counts in transitions.values()))
+                if detectors:
+                    start = start_timer()
+                    dfd, hits, detector_hits = self.analyse_detectors(frame, detectors, hit_range)
+                    scan["detector"].append(dfd)
+                    scan["detector_hits"] += hits
+                    for name, count in detector_hits.items():
+                        scan["detector_rule_hits"][name] = scan["detector_rule_hits"].get(name, 0) + count
+                    add_stage(self.timings, "detectors", start, rows=nrows, matched=hits)
+                if self.report:
+                    columns = [col for col in self.columns_of_interest if col in frame.columns]
+                    merge_points(scan["report_series"],
+                                 sample_points(self.rows_in_range(frame, hit_range), columns, self.report.points),
+                                 self.report.points)
+                pending = max(pending, last + 1)
+                carry = frame.loc[pending - self.lookback - 1:]
+                scan["next_row"] = frame.index[-1] + 1
+            chunk = nxt
+        scan["carry"] = carry
+        scan["pending"] = pending
+        return scan
+
+    def merge_scan(self, total, scan):
+        # adds the scan_chunks scan of the next rows of a file to total, for files scanned a chunk at a time
+        if total is None:
+            return scan
+        for key in ["threshold", "episodes", "state_change", "detector"]:
+            total[key] += scan[key]
+        for key in ["threshold_hits", "detector_hits"]:
+            total[key] += scan[key]
+        for key in ["rule_hits", "detector_rule_hits", "report_anomaly_counts"]:
+            for name, count in scan[key].items():
+                total[key][name] = total[key].get(name, 0) + count
+        merge_transitions(total["transitions"], scan["transitions"])
+        if self.report:
+            merge_points(total["report_series"], scan["report_series"], self.report.points)
+            merge_points(total["report_anomalies"], scan["report_anomalies"], self.report.max_anomaly_points // 2)
+        total.update(carry=scan["carry"], pending=scan["pending"], next_row=scan.get("next_row", total.get("next_row")))
+        return total
+
+    def sample_anomalies(self, scan, frame, rules, hit, hit_masks):
+        # abnormal rows of each threshold column: matched rows where a rule or "not" on the column matched
+        limit = self.report.max_anomaly_points // 2
+        if not hit.any():
+            return
+        for col in dict.fromkeys(rules.columns()):
+            mask = np.zeros(frame.shape[0], dtype=bool)
+            for matcher in rules.matchers():
+                if col in matcher.columns():
+                    mask |= hit_masks[matcher.name]
+            if not mask.any():
+                continue
+            scan["report_anomaly_counts"][col] = scan["report_anomaly_counts"].get(col, 0) + int(mask.sum())
+            merge_points(scan["report_anomalies"], sample_points(frame[mask], [col], limit), limit)
 
     def is_duplicate(self, lst):
         checked = []
@@ -170,94 +606,613 @@ class AnalyseData(Common):
             checked.append(item)
         return False
 
-    def find_abnormalities(self, cfiles, jsondata):
-        
-        dfmain = pd.DataFrame()
-        dfmain_sc = pd.DataFrame()
-        dfall = pd.DataFrame()
-        dfall_sc = pd.DataFrame()
-        pbar = tqdm(range(len(cfiles)), desc ="\nProgress on number of files processed", ncols=100)
-        for cf in cfiles:
-            pbar.update()
-            self.cols_to_print = list(["Local Computer Time"])
-            self.logger.debug(f"columns to print {self.cols_to_print}")
+    def is_profiled(self, cf):
+        if not self.profile_file:
+            return False
+        return (os.path.basename(cf) == self.profile_file or
+                os.path.abspath(cf) == os.path.abspath(self.profile_file))
 
-            self.logger.info(f"\n----------------Analysing file {cf}--------------------- ")
-            try:
-                df = pd.read_csv(cf,
-                                 skiprows=self.skiprows,
-                                 usecols=lambda x: x in self.load_columns_from_csv,
-                                 low_memory=False)
-                df.insert(0, "filename", cf)
-                self.cols_to_print.append("filename")
+    def analyse_file(self, cf):
+        #wall/cpu seconds and rows per stage on this file
+        self.timings = dict()
+        if self.is_profiled(cf):
+            outbase = os.path.join(self.outdir, "profile_" + os.path.splitext(os.path.basename(cf))[0])
+            result = profile_call(outbase, self.profile_memory, self.process_file, cf)
+        else:
+            result = self.process_file(cf)
+        #results loaded from the cache carry the timings of the run that stored them
+        result["timings"] = self.timings
+        result["process_peak_rss_mb"] = process_peak_rss_mb()
+        return result
 
-            except Exception as e:
-                self.logger.error(f"Error parsing file {cf}: {e}")
-                continue
-            
-            if "Local Computer Time" not in df.columns:
-                self.logger.debug(df.columns)
-                self.logger.error(f"ERROR: Exiting the file because column: Local Computer Time not found columns are not found in {cf}")
-                continue
-                
-            for col in self.extra_columns:
-                if col in df.columns:
-                    self.cols_to_print.append(col)
-                else:
-                    self.logger.warning(f"Warning: Could not find extra column {col} in {cf}. Skipping this column")
-                    #self.cols_to_print.remove(col)
-
-            dfr = self.analyse_threshold(df, cf)
-            if not dfr.empty:
-                dfmain = pd.concat([dfmain, dfr[list(self.cols_to_print)]], axis=0).drop_duplicates()
-                self.logger.info(f"dfmain: memory usage: {dfmain.memory_usage().sum()/1e6} MB")
+    def new_result(self, cf):
+        self.stats = ""
+        self.total_toggles = 0
+        self.bool_columns = set()
+        self.cols_to_print = list(["Local Computer Time"])
+        self.logger.debug(f"columns to print {self.cols_to_print}")
+        return {"filename": cf, "threshold": pd.DataFrame(), "threshold_detailed": pd.DataFrame(),
+                "threshold_episodes": pd.DataFrame(),
+                "state_change": pd.DataFrame(), "state_change_detailed": pd.DataFrame(),
+                "detector": pd.DataFrame(), "detector_detailed": pd.DataFrame(),
+                "threshold_matched_rows": 0,
+                "stats": "", "toggles": 0, "transitions": dict(), "cached": False, "timings": dict()}
+
+    def select_columns(self, cf, columns, warn=True):
+        # columns to print and the rules, state changes and detectors for the columns of a file
+        self.cols_to_print.append("filename")
+        for col in self.extra_columns:
+            if col in columns:
+                self.cols_to_print.append(col)
+            elif warn:
+                self.logger.warning(f"Warning: Could not find extra column {col} in {cf}. Skipping this column")
+                #self.cols_to_print.remove(col)
+
+        rules = self.threshold_expression(columns, cf)
+        threshold_cols = list(self.cols_to_print)
+        sc_specs = self.state_change_specs(columns, cf)
+        for col in self.detector_column_list:
+            if col not in columns:
+                self.logger.info(f"Detector column: {col} not found in {cf}")
+        detectors = [detector for detector in self.detectors if detector.column in columns]
+        return rules, threshold_cols, sc_specs, detectors
+
+    def lookup_cache(self, cf):
+        # (cache entry, cached result) of cf, the entry is None without a result cache
+        if not self.result_cache:
+            return None, None
+        start = start_timer()
+        cache_entry = self.result_cache.entry_path(cf)
+        cached = self.result_cache.get(cache_entry)
+        add_stage(self.timings, "cache", start)
+        if cached is not None:
+            self.logger.info(f"Using cached results for {cf}")
+            cached["cached"] = True
+        return cache_entry, cached
+
+    def check_header(self, cf, header):
+        if "Local Computer Time" not in header:
+            self.logger.debug(header)
+            self.logger.error(f"ERROR: Exiting the file because column: Local Computer Time not found columns are not found in {cf}")
+            return False
+
+        if not any(col in header for col in self.columns_of_interest):
+            self.logger.info(f"Skipping file {cf}, none of the threshold or state change columns found")
+            return False
+        return True
+
+    def process_file(self, cf):
+        result = self.new_result(cf)
+
+        self.logger.info(f"\n----------------Analysing file {cf}--------------------- ")
+        try:
+            cache_entry, cached = self.lookup_cache(cf)
+        except OSError as e:
+            self.logger.error(f"Error reading file {cf}: {e}")
+            return result
+        if cached is not None:
+            return cached
+
+        try:
+            _, header = self.read_header(cf)
+        except Exception as e:
+            self.logger.error(f"Error parsing file {cf}: {e}")
+            return result
+
+        if not self.check_header(cf, header):
+            return result
+
+        byte_range = None
+        if self.time_window:
+            byte_range = self.time_index.byte_range(cf, *self.time_window)
+            if byte_range and byte_range[0] >= byte_range[1]:
+                self.logger.info(f"Skipping file {cf}, no rows between {self.time_window[0]} and {self.time_window[1]}")
+                return result
+
+        try:
+            start = start_timer()
+            chunks = self.read_chunks(cf, [col for col in header if col in self.load_columns_from_csv], byte_range)
+            df = next(chunks)
+            add_stage(self.timings, "parse", start, rows=df.shape[0], nbytes=input_size(cf))
+
+        except Exception as e:
+            self.logger.error(f"Error parsing file {cf}: {e}")
+            return result
+
+        if "Local Computer Time" not in df.columns:
+            self.logger.debug(df.columns)
+            self.logger.error(f"ERROR: Exiting the file because column: Local Computer Time not found columns are not found in {cf}")
+            return result
+
+        rules, threshold_cols, sc_specs, detectors = self.select_columns(cf, df.columns)
+        try:
+            scan = self.scan_chunks(df, chunks, rules, sc_specs, detectors=detectors)
+        except Exception as e:
+            self.logger.error(f"Error parsing file {cf}: {e}")
+            return result
+
+        self.collect_scan(result, cf, scan, rules, threshold_cols, sc_specs, detectors)
+        if cache_entry:
+            self.result_cache.put(cache_entry, result)
+        return result
+
+    def collect_scan(self, result, cf, scan, rules, threshold_cols, sc_specs, detectors=None):
+        # logs the findings of scan_chunks and stores them in result
+        if rules:
+            expr = rules.expression()
+            result["threshold_matched_rows"] = scan["threshold_hits"]
+            if scan["threshold_hits"] == 0:
+                self.logger.info(f"Does not exceed threshold in file {cf}")
+            else:
+                self.logger.info(f"Threshold crossed {scan['threshold_hits']} times in file {cf} for expression {expr}")
+                self.stats += f"Threshold crossed {scan['threshold_hits']} times in file {cf} for expression {expr}<br>"
+                for name, count in scan["rule_hits"].items():
+                    self.logger.info(f"---Rule {name} matched {count} rows")
+                    self.stats += f"---Rule {name} matched {count} rows<br>"
+                dfr = pd.concat(scan["threshold"], axis=0).drop_duplicates()
+                result["threshold"] = dfr[threshold_cols]
                 if self.create_detailed_csv:
-                    dfall = pd.concat([dfall, dfr], axis=0).drop_duplicates()
-                    self.logger.info(f"dfall: memory usage: {dfall.memory_usage().sum()/1e6} MB")
+                    result["threshold_detailed"] = dfr
+            episodes = merge_episodes(scan["episodes"], self.episode_max_gap)
+            if not episodes.empty:
+                self.logger.info(f"Threshold crossed in {episodes.shape[0]} episodes in file {cf}")
+                result["threshold_episodes"] = episode_table(episodes, cf)
 
-            dfs = self.analyse_state_change(df, cf)
+        if sc_specs and scan["state_change"]:
+            for col, counts in scan["transitions"].items():
+                for (value_from, value_to), count in counts.items():
+                    self.logger.info(f"Number of times state change in {col} from {value_from} to {value_to} : {count}")
+                    self.total_toggles += count
+            result["transitions"] = scan["transitions"]
+            dfs = pd.concat(scan["state_change"], axis=0).drop_duplicates()
             if not dfs.empty:
-                dfmain_sc = pd.concat([dfmain_sc, dfs[list(self.cols_to_print)]], axis=0).drop_duplicates()
-                self.logger.info(f"dfmain_sc: memory usage: {dfmain_sc.memory_usage(deep=True).sum()/1e6} MB")
+                result["state_change"] = dfs[list(self.cols_to_print)]
+                if self.create_detailed_csv:
+                    result["state_change_detailed"] = dfs
+
+        if detectors:
+            if scan["detector_hits"] == 0:
+                self.logger.info(f"No detector matched in file {cf}")
+            else:
+                self.logger.info(f"Detectors matched {scan['detector_hits']} rows in file {cf}")
+                self.stats += f"Detectors matched {scan['detector_hits']} rows in file {cf}<br>"
+                for name, count in scan["detector_rule_hits"].items():
+                    self.logger.info(f"---Detector {name} matched {count} rows")
+                    self.stats += f"---Detector {name} matched {count} rows<br>"
+                dfd = pd.concat(scan["detector"], axis=0).drop_duplicates()
+                detector_cols = [col for col in self.cols_to_print if col not in self.columns_of_interest]
+                detector_cols += [col for col in dict.fromkeys(x.column for x in detectors) if col not in detector_cols]
+                result["detector"] = dfd[detector_cols]
                 if self.create_detailed_csv:
-                    dfall_sc = pd.concat([dfall_sc, dfs], axis=0).drop_duplicates()
-                    self.logger.info(f"dfall_sc: memory usage: {dfall_sc.memory_usage(deep=True).sum()/1e6} MB")
-            self.logger.debug(f"columns to print {self.cols_to_print}")
+                    result["detector_detailed"] = dfd
+        self.logger.debug(f"columns to print {self.cols_to_print}")
 
+        result["stats"] = self.stats
+        result["toggles"] = self.total_toggles
+        result["rule_hits"] = scan["rule_hits"]
+        result["bool_columns"] = sorted(self.bool_columns)
+        for key in ["report_series", "report_anomalies", "report_anomaly_counts"]:
+            result[key] = scan[key]
+        return result
 
-        if dfmain.empty and dfmain_sc.empty:
-            self.logger.info("No output to process")
+    def iter_file_results(self, cfiles, pbar):
+        if self.workers <= 1 or len(cfiles) <= 1 or self.row_dedup:
+            for cf in cfiles:
+                pbar.update()
+                yield self.analyse_file(cf)
+            return
+
+        self.logger.info(f"Analysing {len(cfiles)} files with {self.workers} worker processes")
+        # results are yielded in input order, completed results wait here until their turn
+        done = dict()
+        next_idx = 0
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            futures = {executor.submit(_analyse_file_worker, cf): idx for idx, cf in enumerate(cfiles)}
+            for future in as_completed(futures):
+                pbar.update()
+                done[futures[future]] = future.result()
+                while next_idx in done:
+                    yield done.pop(next_idx)
+                    next_idx += 1
+
+    def open_sinks(self, outfile=None, append=False):
+        outfile = outfile or self.outfile
+        return {kind: CsvSink(outfile + suffix, append=append) for kind, suffix in OUTPUT_SUFFIXES.items()}
+
+    def write_output(self, sink, df, label, result):
+        out = expand_frame(df, result.get("bool_columns", list())) if self.memory_lean else df
+        rows = sink.write(out)
+        usage = f"{df.memory_usage(deep=True).sum()/1e6} MB"
+        if self.memory_lean:
+            usage += f" ({out.memory_usage(deep=True).sum()/1e6} MB without memory_lean)"
+        self.logger.info(f"{label}: {rows} rows written, memory usage: {usage}")
+
+    def write_result(self, result, sinks):
+        start = start_timer()
+        # results from caches written before the matched rows were kept count none
+        self.threshold_rows["matched"] += result.get("threshold_matched_rows", 0)
+        self.threshold_rows["output"] += result["threshold"].shape[0]
+        if not result["threshold"].empty:
+            self.write_output(sinks["threshold"], result["threshold"], "threshold", result)
+            if self.create_detailed_csv:
+                self.write_output(sinks["threshold_detailed"], result["threshold_detailed"], "threshold detailed", result)
+
+        if not result.get("threshold_episodes", pd.DataFrame()).empty:
+            self.write_output(sinks["threshold_episodes"], result["threshold_episodes"], "threshold episodes", result)
+
+        if not result["state_change"].empty:
+            self.write_output(sinks["state_change"], result["state_change"], "state change", result)
+            if self.create_detailed_csv:
+                self.write_output(sinks["state_change_detailed"], result["state_change_detailed"], "state change detailed", result)
+
+        if not result.get("detector", pd.DataFrame()).empty:
+            self.write_output(sinks["detector"], result["detector"], "detector", result)
+            if self.create_detailed_csv:
+                self.write_output(sinks["detector_detailed"], result["detector_detailed"], "detector detailed", result)
+        add_stage(self.stage_times, "output", start,
+                  rows=result["threshold"].shape[0] + result["state_change"].shape[0])
+
+    def find_abnormalities(self, cfiles):
+        
+        sinks = self.open_sinks()
+        totals = self.new_totals()
+        pbar = tqdm(range(len(cfiles)), desc ="\nProgress on number of files processed", ncols=100)
+        for result in self.iter_file_results(cfiles, pbar):
+            self.add_result(result, sinks, totals)
+        pbar.close()
+        self.end_results(totals, len(cfiles))
+        if not self.finish_run(sinks):
             sys.exit(-1)
 
-        if not dfmain.empty:
-            self.logger.debug(f"Saving dfmain to {self.outfile} _threshold.csv")
-            dfmain.to_csv(self.outfile + "_threshold.csv", index=False)
-            self.prepend_extra_lines_csv(4, self.outfile + "_threshold.csv")
+    def new_totals(self):
+        # totals over the files of a run, kept apart from stats and total_toggles, which new_result resets
+        return {"stats": "", "toggles": 0, "transitions": dict(), "cache_hits": 0}
+
+    def add_result(self, result, sinks, totals):
+        totals["stats"] += result["stats"]
+        totals["toggles"] += result["toggles"]
+        merge_transitions(totals["transitions"], result["transitions"])
+        merge_stages(self.stage_times, result["timings"])
+        self.add_file_metrics(result)
+        totals["cache_hits"] += result["cached"]
+        self.write_result(result, sinks)
+        if self.report:
+            self.report.add(result)
+
+    def end_results(self, totals, nfiles):
+        if self.result_cache:
+            self.logger.info(f"Result cache: {totals['cache_hits']} hits, {nfiles - totals['cache_hits']} misses")
+            self.result_cache.evict()
+        self.stats = totals["stats"]
+        self.total_toggles = totals["toggles"]
+        self.transitions = totals["transitions"]
+
+    def finish_run(self, sinks):
+        # logs the totals and outputs of a run, False when nothing was found
+        threshold_sink = sinks["threshold"]
+        state_change_sink = sinks["state_change"]
+        threshold_detailed_sink = sinks["threshold_detailed"]
+        state_change_detailed_sink = sinks["state_change_detailed"]
+        for col, counts in self.transitions.items():
+            for (value_from, value_to), count in counts.items():
+                self.logger.info(f"Total number of state changes in {col} from {value_from} to {value_to}: {count}")
+        self.logger.info(f"Total number of state changes: {self.total_toggles}")
+        self.save_metrics()
+        if self.report:
+            start = start_timer()
+            self.write_report(sinks)
+            add_stage(self.stage_times, "report", start)
+
+        if not threshold_sink.rows_written and not state_change_sink.rows_written and not sinks["detector"].rows_written:
+            self.logger.info("No output to process")
+            return False
+
+        if threshold_sink.rows_written:
             #fig = px.bar(dfmain, y=self.threshold_column_of_interest, x="Local Computer Time")
             self.logger.info(f"Threshold cross Output saved to {self.outfile}_threshold.csv")
 
+        if threshold_detailed_sink.rows_written:
+            self.logger.info(f"Detailed  Output saved to {self.outfile}_threshold_detailed.csv")
 
-        if self.create_detailed_csv:  # Correct handling of create_detailed_csv
-            dfall.to_csv(self.outfile + "_threshold_detailed.csv", index=False)
-            dfall_sc.to_csv(self.outfile + "_state_toggle_detailed.csv", index=False)
-            self.prepend_extra_lines_csv(4, self.outfile + "_threshold_detailed.csv")
-            self.logger.info(f"Detailed  Output saved to {self.outfile}_detailed.csv")
-            self.prepend_extra_lines_csv(4, self.outfile + "_state_toggle_detailed.csv")
-            self.logger.info(f"Detailed  Output saved to {self.outfile}_threshold_detailed.csv and {self.outfile}_state_toggle_detailed.csv")
-
+        if sinks["threshold_episodes"].rows_written:
+            self.logger.info(f"Episodes Output saved to {self.outfile}_threshold_episodes.csv")
 
+        if state_change_detailed_sink.rows_written:
+            self.logger.info(f"Detailed  Output saved to {self.outfile}_state_toggle_detailed.csv")
 
-        if not dfmain_sc.empty:
-            dfmain_sc.to_csv(self.outfile + "_state_toggle.csv", index=False)
-            self.prepend_extra_lines_csv(4, self.outfile + "_state_toggle.csv")
+        if state_change_sink.rows_written:
             self.logger.info(f"State change Output saved to {self.outfile}_state_toggle.csv")
 
+        if sinks["detector"].rows_written:
+            self.logger.info(f"Detector Output saved to {self.outfile}_detector.csv")
+
+        if sinks["detector_detailed"].rows_written:
+            self.logger.info(f"Detailed  Output saved to {self.outfile}_detector_detailed.csv")
+
         self.logger.info(f"All results saved in directory: {self.outdir}")
         # Your code here
         timeelapsed = time.time() - self.starttimestamp
         hours, rem = divmod(timeelapsed, 3600)
         minutes, seconds = divmod(rem, 60)
         self.logger.info("Processing time: {:0>2}:{:0>2}:{:05.1f}".format(int(hours), int(minutes), seconds))
+        self.logger.info("Time per stage: " + ", ".join(f"{stage} {entry['wall_seconds']:.2f}s (cpu {entry['cpu_seconds']:.2f}s)"
+                                                        for stage, entry in self.stage_times.items()))
+        return True
+
+    def run_shards(self):
+        # analyses the shards this worker gets a lease on, the last worker to finish merges them
+        if not self.shard_directory:
+            self.logger.error("Set shard_directory in the input json to a directory shared by the workers")
+            sys.exit(-1)
+        coordinator = ShardCoordinator(self.shard_directory, self.shard_size, self.lease_timeout)
+        self.logger.info(f"Worker {coordinator.worker_id} using shard directory {self.shard_directory}")
+        if self.row_dedup:
+            self.logger.warning("dedupe_rows finds repeated rows within the shards of this worker only")
+
+        def find_files():
+            start = start_timer()
+            cfiles = self.get_files(self.jsondata) or list()
+            add_stage(self.stage_times, "discovery", start, rows=len(cfiles))
+            return cfiles
+
+        coordinator.plan(find_files)
+        analysed = 0
+        for shard, cfiles in coordinator.shards():
+            self.analyse_shard(coordinator, shard, cfiles)
+            analysed += 1
+        self.logger.info(f"Worker {coordinator.worker_id} analysed {analysed} shards")
+        self.save_metrics()
+        for _ in coordinator.merge_leases():
+            self.merge_shards(coordinator)
+        self.logger.info(f"Merged outputs are in {coordinator.merged()}")
+
+    def analyse_shard(self, coordinator, shard, cfiles):
+        self.logger.info(f"Analysing {coordinator.shard_name(shard)} with {len(cfiles)} files")
+        work = coordinator.work_dir(shard)
+        sinks = self.open_sinks(os.path.join(work, "shard"))
+        summary = {"worker": coordinator.worker_id, "files": cfiles, "stats": "", "toggles": 0,
+                   "transitions": dict(), "stages": dict(), "file_metrics": list()}
+        first_metric = len(self.file_metrics)
+        pbar = tqdm(range(len(cfiles)), desc=f"\nProgress on {coordinator.shard_name(shard)}", ncols=100)
+        for result in self.iter_file_results(cfiles, pbar):
+            summary["stats"] += result["stats"]
+            summary["toggles"] += result["toggles"]
+            merge_transitions(summary["transitions"], result["transitions"])
+            merge_stages(summary["stages"], result["timings"])
+            merge_stages(self.stage_times, result["timings"])
+            self.add_file_metrics(result)
+            self.write_result(result, sinks)
+        pbar.close()
+        summary["file_metrics"] = self.file_metrics[first_metric:]
+        coordinator.finish(shard, work, summary)
+
+    def merge_shards(self, coordinator=None):
+        # combines the outputs and summaries of the analysed shards into the outputs of this run,
+        # rows found in several shards are written once
+        if coordinator is None:
+            if not self.shard_directory:
+                self.logger.error("Set shard_directory in the input json to the directory of the sharded run")
+                sys.exit(-1)
+            coordinator = ShardCoordinator(self.shard_directory, self.shard_size, self.lease_timeout)
+            if coordinator.load_plan() is None:
+                self.logger.error(f"No sharded run found in {self.shard_directory}")
+                sys.exit(-1)
+        if self.report:
+            self.logger.warning("create_report is not supported for sharded runs, no report is written")
+            self.report = None
+        self.logger.info(f"Merging {len(coordinator.shard_files)} shards from {self.shard_directory}")
+        self.stats = ""
+        self.total_toggles = 0
+        self.transitions = dict()
+        self.stage_times = dict()
+        self.file_metrics = list()
+        self.threshold_rows = {"matched": 0, "output": 0}
+        sinks = self.open_sinks()
+        start = start_timer()
+        rows = 0
+        for shard, done, summary in coordinator.done_shards():
+            self.stats += summary["stats"]
+            self.total_toggles += summary["toggles"]
+            merge_transitions(self.transitions, summary["transitions"])
+            merge_stages(self.stage_times, summary["stages"])
+            self.file_metrics += summary["file_metrics"]
+            for x in summary["file_metrics"]:
+                self.threshold_rows["matched"] += x.get("threshold_matched_rows", 0)
+                self.threshold_rows["output"] += x.get("threshold_output_rows", 0)
+            for kind, sink in sinks.items():
+                shard_csv = os.path.join(done, "shard" + OUTPUT_SUFFIXES[kind])
+                if not os.path.exists(shard_csv):
+                    continue
+                # values are copied as written by the shards
+                for chunk in pd.read_csv(shard_csv, skiprows=sink.number_of_extra_lines, dtype=str,
+                                         keep_default_na=False, chunksize=100000):
+                    rows += sink.write(chunk)
+        add_stage(self.stage_times, "merge", start, rows=rows)
+        coordinator.finish_merge(self.outdir)
+        if not self.finish_run(sinks):
+            sys.exit(-1)
+
+    def follow(self, poll_interval=None):
+        # analyses the rows appended to the input files every poll_interval seconds until interrupted,
+        # findings are appended to the same output csvs, also those of an earlier run in the same minute
+        poll_interval = poll_interval or self.jsondata.get("poll_interval", 5)
+        state = FollowState(self.follow_state_file)
+        sinks = self.open_sinks(append=True)
+        total_toggles = 0
+        self.logger.info(f"Following input files every {poll_interval}s, stop with Ctrl+C")
+        try:
+            while True:
+                start = start_timer()
+                cfiles = self.get_files(self.jsondata) or list()
+                add_stage(self.stage_times, "discovery", start, rows=len(cfiles))
+                for cf in cfiles:
+                    result, advance = self.follow_file(cf, state)
+                    total_toggles += result["toggles"]
+                    merge_transitions(self.transitions, result["transitions"])
+                    merge_stages(self.stage_times, result["timings"])
+                    self.write_result(result, sinks)
+                    # the state moves past the rows only once their findings are written
+                    if advance:
+                        advance()
+                state.save()
+                self.total_toggles = total_toggles
+                self.save_metrics()
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            self.logger.info("Stopped following input files")
+        state.save()
+        self.total_toggles = total_toggles
+        self.save_metrics()
+        for col, counts in self.transitions.items():
+            for (value_from, value_to), count in counts.items():
+                self.logger.info(f"Total number of state changes in {col} from {value_from} to {value_to}: {count}")
+        self.logger.info(f"Total number of state changes: {self.total_toggles}")
+        self.logger.info(f"All results saved in directory: {self.outdir}")
+
+    def start_following(self, cf, state):
+        skipped, header = self.read_header(cf)
+        entry = state.start(cf, skipped, header)
+        if entry is None:
+            return None
+        if "Local Computer Time" not in header:
+            self.logger.error(f"ERROR: Not following file {cf} because column: Local Computer Time is not found")
+            entry["skip"] = True
+        elif not any(col in header for col in self.columns_of_interest):
+            self.logger.info(f"Not following file {cf}, none of the threshold or state change columns found")
+            entry["skip"] = True
+        return entry
+
+    def renumber_chunks(self, chunks, first_row):
+        # row numbers continue from the rows read at earlier polls
+        for chunk in chunks:
+            chunk.index = chunk.index + first_row
+            yield chunk
+
+    def follow_file(self, cf, state):
+        # analyses the complete rows appended to cf since the last poll. Returns the result and the
+        # function that updates the state of cf past these rows, called after the result is written
+        self.timings = dict()
+        result = self.new_result(cf)
+        result["timings"] = self.timings
+        if is_compressed(cf):
+            # compressed files are not appended to, they are analysed once when they are found
+            if state.get(cf) is None:
+                return self.analyse_file(cf), lambda: state.finish(cf)
+            return result, None
+        try:
+            size = os.path.getsize(cf)
+            entry = state.get(cf)
+            if entry and size < entry["offset"]:
+                self.logger.warning(f"{cf} is shorter than at the last poll, reading it from the start")
+                entry = None
+            if entry is None:
+                entry = self.start_following(cf, state)
+            if entry is None or entry["skip"]:
+                return result, None
+            end = state.complete_end(cf, entry["offset"], size)
+        except OSError as e:
+            self.logger.error(f"Error reading file {cf}: {e}")
+            return result, None
+        if end <= entry["offset"]:
+            return result, None
+
+        self.logger.debug(f"Analysing {end - entry['offset']} new bytes of file {cf}")
+        usecols = [col for col in entry["header"] if col in self.load_columns_from_csv]
+        rules, threshold_cols, sc_specs, detectors = self.select_columns(cf, ["filename"] + usecols, warn=not entry["next_row"])
+        try:
+            start = start_timer()
+            chunks = self.renumber_chunks(self.read_chunks(cf, usecols, (entry["offset"], end)), entry["next_row"])
+            df = next(chunks)
+            add_stage(self.timings, "parse", start, rows=df.shape[0], nbytes=end - entry["offset"])
+            scan = self.scan_chunks(df, chunks, rules, sc_specs, entry["carry"], entry["pending"], final=False,
+                                    detectors=detectors)
+        except Exception as e:
+            # the rows are skipped, reading them again would fail at every poll
+            self.logger.error(f"Error parsing file {cf}: {e}")
+            entry["offset"] = end
+            return result, None
+
+        update = dict(offset=end, carry=scan["carry"], pending=scan["pending"],
+                      next_row=scan.get("next_row", entry["next_row"]))
+        if self.create_episodes:
+            # the last episode is written once rows after it show that it ended
+            episodes = merge_episodes([entry.get("episode", pd.DataFrame())] + scan["episodes"], self.episode_max_gap)
+            update["episode"] = pd.DataFrame()
+            if not episodes.empty and scan["pending"] - episodes["last_row"].iloc[-1] - 1 <= self.episode_max_gap:
+                update["episode"] = episodes.iloc[-1:]
+                episodes = episodes.iloc[:-1]
+            scan["episodes"] = [episodes]
+        result = self.collect_scan(result, cf, scan, rules, threshold_cols, sc_specs, detectors)
+        return result, lambda: entry.update(update)
+
+    def write_report(self, sinks):
+        thresholds = dict()
+        if self.threshold_rules:
+            for leaf in self.threshold_rules.leaves():
+                thresholds.setdefault(leaf.column, list()).append((leaf.name, leaf.value))
+        timeelapsed = time.time() - self.starttimestamp
+        run_summary = {"files": len(self.file_metrics),
+                       "rows": self.stage_times.get("parse", dict()).get("rows", 0),
+                       "threshold crossings": self.stage_times.get("threshold", dict()).get("matched", 0),
+                       "state changes": self.total_toggles,
+                       "processing time (s)": round(timeelapsed, 1)}
+        outputs = {"threshold": sinks["threshold"].csv_file, "state_change": sinks["state_change"].csv_file}
+        try:
+            self.report.write(f"Abnormalities in {os.path.basename(self.outfile)}", run_summary,
+                              self.transitions, thresholds, outputs)
+        except Exception as e:
+            self.logger.error(f"Could not write report {self.report.report_file}: {e}")
+
+    def add_file_metrics(self, result):
+        parse = result["timings"].get("parse", dict())
+        wall = sum(entry["wall_seconds"] for entry in result["timings"].values())
+        self.file_metrics.append({
+            "filename": result["filename"],
+            "cached": result["cached"],
+            "rows": parse.get("rows", 0),
+            "bytes": parse.get("bytes", 0),
+            "wall_seconds": wall,
+            "rows_per_second": parse.get("rows", 0) / wall if wall else None,
+            "threshold_matched_rows": result.get("threshold_matched_rows", 0),
+            "threshold_output_rows": result["threshold"].shape[0],
+            "threshold_episodes": result["threshold_episodes"].shape[0],
+            "state_change_rows": result["state_change"].shape[0],
+            "detector_rows": result["detector"].shape[0],
+            "toggles": result["toggles"],
+            "process_peak_rss_mb": result.get("process_peak_rss_mb", None),
+            "stages": with_rates(result["timings"]),
+        })
+
+    def save_metrics(self):
+        # metrics.json in the output directory: totals of the run, per stage and per file
+        wall = time.time() - self.starttimestamp
+        peaks = [x.get("process_peak_rss_mb") for x in self.file_metrics if x.get("process_peak_rss_mb") is not None]
+        if process_peak_rss_mb() is not None:
+            peaks.append(process_peak_rss_mb())
+        parse = self.stage_times.get("parse", dict())
+        metrics = {
+            "run": {
+                "start": datetime.fromtimestamp(self.starttimestamp).isoformat(),
+                "wall_seconds": wall,
+                "cpu_seconds": process_cpu_seconds(),
+                "workers": self.workers,
+                "files": len(self.file_metrics),
+                "cached_files": sum(x["cached"] for x in self.file_metrics),
+                "rows": parse.get("rows", 0),
+                "bytes": parse.get("bytes", 0),
+                "rows_per_second": parse.get("rows", 0) / wall if wall else None,
+                "threshold_matched_rows": self.threshold_rows["matched"],
+                "threshold_output_rows": self.threshold_rows["output"],
+                "state_changes": self.total_toggles,
+                "process_peak_rss_mb": max(peaks) if peaks else None,
+            },
+            "stages": with_rates(self.stage_times),
+            "files": self.file_metrics,
+        }
+        write_metrics(os.path.join(self.outdir, "metrics.json"), metrics)
+        self.logger.info(f"Metrics saved to {os.path.join(self.outdir, 'metrics.json')}")
 
     def get_files(self, jsondata):
         input_csvs = jsondata.get("input_csvs", None)
@@ -278,71 +1233,32 @@ class AnalyseData(Common):
                 default end_time is 23.59""")
             sys.exit(-1)
 
-        list_csvs = list()
-
-        if input_csvs:
-            for icsv in input_csvs:
-                if not os.path.exists(icsv):
-                    self.logger.info(f"File not found {icsv}")
-                    continue
-                list_csvs.append(icsv)
-
-        if input_directories:
-            for idir in input_directories:
-                if not os.path.exists(idir) or not os.path.isdir(idir):
-                    self.logger.info(f"Directory not found {idir} or the path is not a directory")
-                    continue
+        discovery = FileDiscovery(jsondata.get("discovery_workers", 8),
+                                  jsondata.get("timestamp_source", "mtime"),
+                                  jsondata.get("filename_timestamp_regex", FILENAME_TIMESTAMP_REGEX),
+                                  jsondata.get("filename_timestamp_format", FILENAME_TIMESTAMP_FORMAT))
+        if discovery.timestamp_source not in ["mtime", "filename"]:
+            self.logger.error(f"Invalid timestamp_source {discovery.timestamp_source}, use mtime or filename")
+            sys.exit(-1)
+        list_csvs = discovery.find(input_csvs, input_directories)
 
-                allcvs = glob.glob( idir + "/**/*.csv", recursive=True )
-                list_csvs += allcvs
-        
         if not list_csvs:
             self.logger.info("No files found to process")
             return None
 
         if remove_duplicates:
             self.logger.info("Removing duplicates")
-        
-            #remove duplicates with same file name even if in different directories:
-            #create a map and then discard
-            tdict = dict()
-            for cf in list_csvs:
-                tdict[cf] = os.path.basename(cf)
-        
-            # Remove duplicate values in dictionary
-            # Using loop
-            temp = []
-            res = dict()
-            for key, val in tdict.items():
-               if val not in temp:
-                   temp.append(val)
-                   res[key] = val
-        
-            list_csvs = list(res.keys())
-
-        toberemoved=list()
-        if number_of_days:
-            for cf in list_csvs:
-                modifiedtstamp = datetime.fromtimestamp(os.path.getmtime(cf))
-                ndays = (datetime.now() - modifiedtstamp).days
-                if ndays <= number_of_days: 
-                    self.logger.info(f"{cf} last modified on {modifiedtstamp} which is within {number_of_days} days. Use this file")
-                else:
-                    self.logger.info(f"{cf} last modified on {modifiedtstamp} which is older than {number_of_days} days, Discard this file")
-                    toberemoved.append(cf)
-        
+            list_csvs = discovery.remove_duplicates(list_csvs)
+
+        if self.time_index:
+            if self.time_window:
+                return self.time_index.filter_files(list_csvs, *self.time_window)
+            self.time_index.update(list_csvs)
+            return list_csvs
+
+        stdatetime, etdatetime = None, None
         if start_date:
             stdatetime, etdatetime = self.construct_datatime_from_input(start_time, start_date, end_time, end_date)
-            for c in list_csvs:
-                modifiedtstamp = datetime.fromtimestamp(os.path.getmtime(c))
-                if not stdatetime < modifiedtstamp < etdatetime:
-                    self.logger.info(f"{c} last modified on {modifiedtstamp} Not in range. Discard this file")
-                    toberemoved.append(c)
-                else:
-                    self.logger.info(f"{c} last modified on {modifiedtstamp} fits in range. use this file")
-        
-        for i in toberemoved:
-            list_csvs.remove(i)
-        
-        
+        list_csvs = discovery.filter_by_date(list_csvs, number_of_days, stdatetime, etdatetime)
+
         return list_csvs
@@ -0,0 +1,151 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import pandas as pd
+
+from analyse import AnalyseData
+from metrics import process_peak_rss_mb
+from synthetic_data import SyntheticTelemetry
+
+# number of files and rows per file of each dataset, "large" is a single multi-GB file
+SCENARIOS = {
+    "small": {"files": 1, "rows": 10000},
+    "medium": {"files": 100, "rows": 10000},
+    "many": {"files": 1000, "rows": 2000},
+    "thousands": {"files": 5000, "rows": 1000},
+    "large": {"files": 1, "rows": 2000000},
+}
+
+
+def prepare_dataset(generator, data_dir, name):
+    # datasets are generated once and reused by later benchmark runs
+    dataset = os.path.join(data_dir, name)
+    marker = os.path.join(dataset, ".complete")
+    if not os.path.exists(marker):
+        scenario = SCENARIOS[name]
+        print(f"Generating dataset {name}: {scenario['files']} files of {scenario['rows']} rows")
+        generator.write_dataset(dataset, scenario["files"], scenario["rows"])
+        with open(marker, "w") as f:
+            f.write(datetime.now().isoformat())
+    nbytes = sum(entry.stat().st_size for entry in os.scandir(dataset) if entry.name.endswith(".csv"))
+    return dataset, nbytes
+
+
+def run_scenario(generator, name, dataset, nbytes, work_dir, settings):
+    # runs in a process of its own, so the peak memory is that of this scenario alone
+    config = generator.rule_config()
+    config.update({
+        "input_directories": [dataset],
+        "output_directory": os.path.join(work_dir, name),
+        "header_start_row": 4,
+        "rows_before_abnormality": 2,
+        "rows_after_abnormality": 2,
+    })
+    config.update(settings)
+    input_json = os.path.join(work_dir, f"{name}.json")
+    with open(input_json, "w") as f:
+        json.dump(config, f, indent=4)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    analyse = AnalyseData(input_json, logging.WARNING)
+    try:
+        analyse.call_analysis()
+    except SystemExit:
+        # find_abnormalities exits when nothing abnormal is found
+        pass
+    wall = time.perf_counter() - start
+    rows = SCENARIOS[name]["files"] * SCENARIOS[name]["rows"]
+    return {
+        "scenario": name,
+        "files": SCENARIOS[name]["files"],
+        "rows": rows,
+        "bytes": nbytes,
+        "wall_seconds": wall,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "rows_per_second": rows / wall if wall else None,
+        "stages": {stage: entry["wall_seconds"] for stage, entry in analyse.stage_times.items()},
+        "peak_rss_mb": max([x["process_peak_rss_mb"] for x in analyse.file_metrics if x["process_peak_rss_mb"]]
+                           + [process_peak_rss_mb() or 0]),
+        "total_toggles": analyse.total_toggles,
+    }
+
+
+def compare(previous_file, results):
+    with open(previous_file) as f:
+        previous = {x["scenario"]: x for x in json.load(f)["results"]}
+    print(f"{'scenario':<12}{'stage':<14}{'previous s':>12}{'now s':>12}{'speedup':>10}")
+    for result in results:
+        old = previous.get(result["scenario"], None)
+        if not old:
+            continue
+        rows = [("total", old["wall_seconds"], result["wall_seconds"])]
+        rows += [(stage, old["stages"].get(stage, 0), seconds) for stage, seconds in result["stages"].items()]
+        for stage, before, now in rows:
+            speedup = f"{before / now:.2f}x" if now else "-"
+            print(f"{result['scenario']:<12}{stage:<14}{before:>12.3f}{now:>12.3f}{speedup:>10}")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        """Benchmark AnalyseData on synthetic PLC telemetry"""
+    )
+    args.add_argument("-s", "--scenarios", default="small",
+                      help=f"Comma separated scenarios to run: {','.join(SCENARIOS)}")
+    args.add_argument("-d", "--data-directory", default="benchmark_data",
+                      help="Directory for generated datasets, reused between runs")
+    args.add_argument("-o", "--output", default=None,
+                      help="Json file to save results to, default benchmark_<date>.json in the work directory")
+    args.add_argument("--work-directory", default="benchmark_runs", help="Directory for outputs of the runs")
+    args.add_argument("-c", "--compare", default=None, help="Results json of an earlier run to compare against")
+    args.add_argument("-w", "--workers", type=int, default=1, help="workers setting of the runs")
+    args.add_argument("--chunk-size", type=int, default=0, help="chunk_size setting of the runs")
+    args.add_argument("--csv-engine", default="c", help="csv_engine setting of the runs")
+    args.add_argument("--float-columns", type=int, default=200, help="Number of float tag columns")
+    args.add_argument("--int-columns", type=int, default=50, help="Number of on/off command columns")
+    args.add_argument("--anomaly-rate", type=float, default=0.001, help="Fraction of float values above threshold")
+    pargs = args.parse_args()
+
+    names = [x.strip() for x in pargs.scenarios.split(",") if x.strip()]
+    unknown = [x for x in names if x not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios {unknown}, choose from {list(SCENARIOS)}")
+        sys.exit(1)
+
+    os.makedirs(pargs.work_directory, exist_ok=True)
+    generator = SyntheticTelemetry(pargs.float_columns, pargs.int_columns, pargs.anomaly_rate)
+    settings = {"workers": pargs.workers, "chunk_size": pargs.chunk_size, "csv_engine": pargs.csv_engine}
+    results = list()
+    for name in names:
+        # datasets differ per shape of the generated data
+        data_dir = os.path.join(pargs.data_directory,
+                                f"f{pargs.float_columns}_i{pargs.int_columns}_a{pargs.anomaly_rate}")
+        dataset, nbytes = prepare_dataset(generator, data_dir, name)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_scenario, generator, name, dataset, nbytes,
+                                     pargs.work_directory, settings).result()
+        results.append(result)
+        print(f"{name}: {result['wall_seconds']:.2f}s, {result['rows_per_second']:.0f} rows/s, stages {result['stages']}")
+
+    report = {
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "cpu_count": os.cpu_count(),
+        "settings": settings,
+        "results": results,
+    }
+    outfile = pargs.output or os.path.join(pargs.work_directory,
+                                           f"benchmark_{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.json")
+    with open(outfile, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {outfile}")
+
+    if pargs.compare:
+        compare(pargs.compare, results)
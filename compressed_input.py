@@ -0,0 +1,185 @@
+import io
+import os
+import gzip
+import queue
+import zipfile
+import threading
+import contextlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# gzip and zstandard compressed csvs, and zip archives of which every csv member is an input file
+COMPRESSED_SUFFIXES = (".csv.gz", ".csv.zst")
+ARCHIVE_SUFFIX = ".zip"
+INPUT_SUFFIXES = (".csv",) + COMPRESSED_SUFFIXES + (ARCHIVE_SUFFIX,)
+
+# decompressed bytes per block and the number of blocks decompressed ahead of the parser
+BLOCK_SIZE = 1 << 20
+PREFETCH_BLOCKS = 8
+
+
+def is_input_name(name):
+    return os.path.normcase(name).endswith(INPUT_SUFFIXES)
+
+
+def is_archive(path):
+    return os.path.normcase(path).endswith(ARCHIVE_SUFFIX)
+
+
+def split_member(cf):
+    # (archive, member) of a csv inside a zip archive, named <archive>.zip/<member>, (cf, None) otherwise
+    lowered = os.path.normcase(cf)
+    pos = lowered.find(ARCHIVE_SUFFIX + "/")
+    while pos >= 0:
+        archive = cf[:pos + len(ARCHIVE_SUFFIX)]
+        if os.path.isfile(archive):
+            return archive, cf[len(archive) + 1:]
+        pos = lowered.find(ARCHIVE_SUFFIX + "/", pos + 1)
+    return cf, None
+
+
+def archive_members(archive):
+    # the input files of a zip archive in archive order, hidden entries are skipped like glob does
+    with zipfile.ZipFile(archive) as zf:
+        names = [info.filename for info in zf.infolist() if not info.is_dir()]
+    return [f"{archive}/{name}" for name in names
+            if os.path.normcase(name).endswith(".csv")
+            and not any(part.startswith(".") or part == "__MACOSX" for part in name.split("/"))]
+
+
+def is_compressed(cf):
+    return os.path.normcase(cf).endswith(COMPRESSED_SUFFIXES) or split_member(cf)[1] is not None
+
+
+def input_exists(cf):
+    archive, member = split_member(cf)
+    if member is None:
+        return os.path.exists(cf)
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            zf.getinfo(member)
+        return True
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return False
+
+
+def input_stat(cf):
+    # stat of the file, of the archive for zip members: a member changes only with its archive
+    return os.stat(split_member(cf)[0])
+
+
+def input_size(cf):
+    # bytes read from disk for the file, the compressed size for zip members
+    archive, member = split_member(cf)
+    if member is None:
+        return os.path.getsize(cf)
+    with zipfile.ZipFile(archive) as zf:
+        return zf.getinfo(member).compress_size
+
+
+def input_name(cf):
+    # file name without the compression suffix, x.csv.gz and a zip member x.csv are copies of x.csv
+    name = os.path.basename(cf)
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.normcase(name).endswith(suffix):
+            return name[:-len(suffix) + len(".csv")]
+    return name
+
+
+def open_input(cf, prefetch=True):
+    # binary stream of the decompressed content of cf. With prefetch the decompression runs in a thread
+    # ahead of the reader, zlib and zstandard release the GIL while they decompress
+    archive, member = split_member(cf)
+    if member is not None:
+        with zipfile.ZipFile(archive) as zf:
+            # the archive file stays open until the member stream is closed
+            stream = zf.open(member)
+    elif os.path.normcase(cf).endswith(".csv.gz"):
+        stream = gzip.open(cf, "rb")
+    elif os.path.normcase(cf).endswith(".csv.zst"):
+        if zstandard is None:
+            raise ValueError(f"zstandard is required to read {cf}, install it with pip install zstandard")
+        stream = zstandard.ZstdDecompressor().stream_reader(open(cf, "rb"), read_across_frames=True, closefd=True)
+    else:
+        stream = open(cf, "rb")
+    if not prefetch:
+        return stream
+    return io.BufferedReader(PrefetchReader(stream), BLOCK_SIZE)
+
+
+def open_text(cf):
+    # text lines of cf, as open(cf, "r") reads them, used for the header lines
+    if not is_compressed(cf):
+        return open(cf, "r", newline="", encoding="utf-8", errors="replace")
+    return io.TextIOWrapper(open_input(cf, prefetch=False), newline="", encoding="utf-8", errors="replace")
+
+
+def csv_source(cf):
+    # what read_csv reads cf from: its path, or a decompressing stream closed with the context
+    if is_compressed(cf):
+        return open_input(cf)
+    return contextlib.nullcontext(cf)
+
+
+class PrefetchReader(io.RawIOBase):
+    # Reads a stream block by block in a thread and hands the blocks to the reader in order, at most
+    # PREFETCH_BLOCKS ahead. Errors of the stream are raised in the reader.
+
+    def __init__(self, stream, block_size=BLOCK_SIZE, depth=PREFETCH_BLOCKS):
+        super().__init__()
+        self.stream = stream
+        self.block_size = block_size
+        self.blocks = queue.Queue(depth)
+        self.block = memoryview(b"")
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.stream.read(self.block_size)
+                self.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.block:
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.block = memoryview(item)
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+
+class DetectorError(ValueError):
+    pass
+
+
+class ZScoreDetector(object):
+    # rows more than threshold standard deviations away from the mean of the window rows before them
+
+    def __init__(self, column, window, threshold, min_periods=None, name=None):
+        self.column = column
+        self.window = int(window)
+        self.threshold = float(threshold)
+        self.min_periods = int(min_periods) if min_periods else self.window
+        if self.window < 2 or not 2 <= self.min_periods <= self.window:
+            raise DetectorError(f"zscore on {column} needs a window of at least 2 rows and min_periods between 2 and window")
+        self.name = name if name else f"zscore({column}, {self.window}) > {self.threshold}"
+        # rows before a row that its result depends on
+        self.lookback = self.window
+
+    def detect(self, values):
+        # the baseline leaves the row itself out, a spike does not raise its own baseline
+        baseline = pd.Series(values).shift(1).rolling(self.window, min_periods=self.min_periods)
+        mean = baseline.mean().to_numpy()
+        std = baseline.std().to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.abs(values - mean) / std
+        return z > self.threshold
+
+
+class RateOfChangeDetector(object):
+    # rows whose value changed by more than max_change since the row periods rows before
+
+    def __init__(self, column, max_change, periods=1, direction="both", name=None):
+        if direction not in ["both", "rise", "fall"]:
+            raise DetectorError(f"Invalid direction {direction} for rate_of_change on {column}, use both, rise or fall")
+        self.column = column
+        self.max_change = float(max_change)
+        self.periods = int(periods)
+        if self.periods < 1:
+            raise DetectorError(f"rate_of_change on {column} needs periods of at least 1")
+        self.direction = direction
+        self.name = name if name else f"rate_of_change({column}, {self.periods}) {direction} > {self.max_change}"
+        self.lookback = self.periods
+
+    def detect(self, values):
+        change = np.full(values.shape[0], np.nan)
+        change[self.periods:] = values[self.periods:] - values[:-self.periods]
+        if self.direction == "rise":
+            return change > self.max_change
+        if self.direction == "fall":
+            return -change > self.max_change
+        return np.abs(change) > self.max_change
+
+
+class StuckDetector(object):
+    # rows at which the value has not changed (by more than tolerance from row to row) for min_run rows
+
+    def __init__(self, column, min_run, tolerance=0.0, name=None):
+        self.column = column
+        self.min_run = int(min_run)
+        if self.min_run < 2:
+            raise DetectorError(f"stuck on {column} needs a min_run of at least 2 rows")
+        self.tolerance = float(tolerance)
+        self.name = name if name else f"stuck({column}) for {self.min_run} rows"
+        self.lookback = self.min_run - 1
+
+    def detect(self, values):
+        n = values.shape[0]
+        new_run = np.ones(n, dtype=bool)
+        if n > 1:
+            # missing values end a run and are never part of one
+            new_run[1:] = ~(np.abs(values[1:] - values[:-1]) <= self.tolerance)
+        positions = np.arange(n)
+        run_start = np.maximum.accumulate(np.where(new_run, positions, 0))
+        return (positions - run_start + 1 >= self.min_run) & ~np.isnan(values)
+
+
+DETECTORS = {
+    "zscore": (ZScoreDetector, ["window", "threshold"], ["min_periods"]),
+    "rate_of_change": (RateOfChangeDetector, ["max_change"], ["periods", "direction"]),
+    "stuck": (StuckDetector, ["min_run"], ["tolerance"]),
+}
+
+
+def compile_detectors(config):
+    # detectors in the input json is a list of dictionaries with type (zscore, rate_of_change or stuck),
+    # column_of_interest (one column or a list of columns), the settings of the type and an optional name
+    if isinstance(config, dict):
+        config = [config]
+    if not isinstance(config, list):
+        raise DetectorError(f"Invalid detectors {config}")
+
+    detectors = list()
+    for entry in config:
+        if not isinstance(entry, dict) or entry.get("type", None) not in DETECTORS:
+            raise DetectorError(f"Invalid detector {entry}, type must be one of {list(DETECTORS)}")
+        cls, required, optional = DETECTORS[entry["type"]]
+        missing = [key for key in required if key not in entry]
+        if missing:
+            raise DetectorError(f"Detector {entry} needs {missing}")
+        columns = entry.get("column_of_interest", None)
+        if isinstance(columns, str):
+            columns = [columns]
+        for column in columns or list():
+            if column == "":
+                continue
+            kwargs = {key: entry[key] for key in required + optional if key in entry}
+            name = entry.get("name", None)
+            if name and len(columns) > 1:
+                name = f"{name} {column}"
+            try:
+                detectors.append(cls(column, name=name, **kwargs))
+            except DetectorError:
+                raise
+            except (TypeError, ValueError) as e:
+                raise DetectorError(f"Invalid detector {entry}: {e}")
+    return detectors
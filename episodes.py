@@ -0,0 +1,65 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+TIME_COLUMN = "Local Computer Time"
+
+
+def find_episodes(df, hit, masks, columns, max_gap=0):
+    # Runs of matching rows of df, rows where hit is true, where runs separated by at most max_gap
+    # rows are one episode. One row per episode with the first and last row number (the index of
+    # df), their times, the number of matching rows, min and max of columns over the matching rows
+    # and a bool column per rule of masks ({rule name: bool array}) that matched in the episode.
+    pos = np.flatnonzero(hit)
+    if pos.shape[0] == 0:
+        return pd.DataFrame()
+    starts = np.flatnonzero(np.r_[True, np.diff(pos) > max_gap + 1])
+    ends = np.r_[starts[1:], pos.shape[0]] - 1
+    index = df.index.to_numpy()
+    times = df[TIME_COLUMN].to_numpy()
+    episodes = {"first_row": index[pos[starts]], "last_row": index[pos[ends]],
+                "start": times[pos[starts]], "end": times[pos[ends]],
+                "rows": np.diff(np.r_[starts, pos.shape[0]])}
+    for col in columns:
+        values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)[pos]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            episodes[f"{col} min"] = np.fmin.reduceat(values, starts)
+            episodes[f"{col} max"] = np.fmax.reduceat(values, starts)
+    for name, mask in masks.items():
+        episodes[f"rule:{name}"] = np.logical_or.reduceat(mask[pos], starts)
+    return pd.DataFrame(episodes)
+
+
+def merge_episodes(episodes, max_gap=0):
+    # episodes of consecutive chunks of a file as one set, episodes on both sides of a chunk
+    # boundary with at most max_gap rows between them are joined
+    episodes = [x for x in episodes if not x.empty]
+    if not episodes:
+        return pd.DataFrame()
+    df = pd.concat(episodes, axis=0, ignore_index=True).sort_values("first_row", kind="stable")
+    new = np.r_[True, df["first_row"].to_numpy()[1:] - df["last_row"].to_numpy()[:-1] > max_gap + 1]
+    aggs = {"first_row": "min", "last_row": "max", "start": "first", "end": "last", "rows": "sum"}
+    for col in df.columns:
+        if col.endswith(" min"):
+            aggs[col] = "min"
+        elif col.endswith(" max") or col.startswith("rule:"):
+            aggs[col] = "max"
+    return df.groupby(np.cumsum(new), sort=False).agg(aggs).reset_index(drop=True)
+
+
+def episode_table(df, cf):
+    # episodes for the output csv: the names of the rules that matched and the duration in seconds
+    rule_cols = [col for col in df.columns if col.startswith("rule:")]
+    names = pd.Series([col[len("rule:"):] + "; " for col in rule_cols], index=rule_cols)
+    rules = df[rule_cols].astype(object).dot(names).str.rstrip("; ")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        start = pd.to_datetime(df["start"], errors="coerce", format="mixed")
+        end = pd.to_datetime(df["end"], errors="coerce", format="mixed")
+    table = pd.DataFrame({"filename": cf, "rules": rules,
+                          "start": df["start"], "end": df["end"],
+                          "duration (s)": (end - start).dt.total_seconds(),
+                          "rows": df["rows"], "first row": df["first_row"], "last row": df["last_row"]})
+    values = df[[col for col in df.columns if col.endswith(" min") or col.endswith(" max")]]
+    return pd.concat([table, values], axis=1)
@@ -0,0 +1,190 @@
+import os
+import re
+import logging
+import zipfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from compressed_input import is_input_name, is_archive, archive_members, input_exists, input_stat, input_name
+
+# timestamp in export file names like Data-GS100B000000001-240227_21.21.55.csv
+FILENAME_TIMESTAMP_REGEX = r"(\d{6}_\d{2}\.\d{2}\.\d{2})"
+FILENAME_TIMESTAMP_FORMAT = "%y%m%d_%H.%M.%S"
+
+
+class FileDiscovery(object):
+    # Finds csv files below input directories with os.scandir. Directories are listed by a pool
+    # of threads, which hides the latency of network mounts, and the files are returned in the
+    # order glob("**/*.csv", recursive=True) returns them. Each file is stat'ed at most once and
+    # only when a modification time is needed. Compressed csvs are found as well and zip archives
+    # are replaced by their csv members, named <archive>.zip/<member>.
+
+    def __init__(self, workers=8, timestamp_source="mtime",
+                 timestamp_regex=FILENAME_TIMESTAMP_REGEX, timestamp_format=FILENAME_TIMESTAMP_FORMAT):
+        self.logger = logging.getLogger('common')
+        self.workers = max(workers, 1)
+        self.timestamp_source = timestamp_source
+        self.timestamp_regex = re.compile(timestamp_regex)
+        self.timestamp_format = timestamp_format
+        self.mtimes = dict()
+
+    def list_directory(self, path):
+        # returns the csv files and the sub directories of path, hidden entries are skipped like glob does
+        files = list()
+        subdirs = list()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        continue
+                    if is_dir:
+                        subdirs.append(entry.path)
+                    elif is_archive(entry.name):
+                        files += self.list_archive(entry.path)
+                    elif is_input_name(entry.name):
+                        files.append(entry.path)
+        except OSError as e:
+            self.logger.warning(f"Could not list directory {path}: {e}")
+        return files, subdirs
+
+    def list_archive(self, path):
+        try:
+            return archive_members(path)
+        except (OSError, zipfile.BadZipFile) as e:
+            self.logger.warning(f"Could not list archive {path}: {e}")
+            return list()
+
+    def walk(self, root):
+        # breadth first over a thread pool, then flattened depth first in listing order
+        listings = dict()
+        st = os.stat(root)
+        visited = {(st.st_dev, st.st_ino)}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self.list_directory, root): root}
+            while pending:
+                done = list(pending)
+                for future in done:
+                    path = pending.pop(future)
+                    files, subdirs = future.result()
+                    children = list()
+                    for subdir in subdirs:
+                        # symlinked directories may loop back
+                        try:
+                            st = os.stat(subdir)
+                        except OSError:
+                            continue
+                        if (st.st_dev, st.st_ino) in visited:
+                            continue
+                        visited.add((st.st_dev, st.st_ino))
+                        children.append(subdir)
+                        pending[executor.submit(self.list_directory, subdir)] = subdir
+                    listings[path] = (files, children)
+
+        found = list()
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            files, children = listings[path]
+            found += files
+            stack += reversed(children)
+        return found
+
+    def find(self, input_csvs, input_directories):
+        found = list()
+        for icsv in input_csvs or list():
+            if not input_exists(icsv):
+                self.logger.info(f"File not found {icsv}")
+                continue
+            if is_archive(icsv):
+                found += self.list_archive(icsv)
+            else:
+                found.append(icsv)
+
+        for idir in input_directories or list():
+            if not os.path.isdir(idir):
+                self.logger.info(f"Directory not found {idir} or the path is not a directory")
+                continue
+            found += self.walk(idir)
+        return found
+
+    def remove_duplicates(self, files):
+        # files with the same name in different directories are analysed once, the first one is kept.
+        # Compressed copies have the name of the csv they were made from
+        seen = set()
+        unique = list()
+        for cf in files:
+            name = input_name(cf)
+            if name not in seen:
+                seen.add(name)
+                unique.append(cf)
+        return unique
+
+    def mtime(self, cf):
+        if cf not in self.mtimes:
+            self.mtimes[cf] = datetime.fromtimestamp(input_stat(cf).st_mtime)
+        return self.mtimes[cf]
+
+    def filename_timestamp(self, cf):
+        match = self.timestamp_regex.search(os.path.basename(cf))
+        if match:
+            try:
+                return datetime.strptime(match.group(1), self.timestamp_format)
+            except ValueError:
+                pass
+        return None
+
+    def timestamp(self, cf):
+        # time used for the date filters: the time in the file name, or the modification time
+        # when configured or when the name has none
+        if self.timestamp_source == "filename":
+            tstamp = self.filename_timestamp(cf)
+            if tstamp is not None:
+                return tstamp
+            self.logger.debug(f"No timestamp in file name {cf}, using the modification time")
+        return self.mtime(cf)
+
+    def prefetch_timestamps(self, files):
+        # stat the files over the thread pool, only those the date filters need a modification time for
+        if self.timestamp_source == "filename":
+            files = [cf for cf in files if self.filename_timestamp(cf) is None]
+        files = [cf for cf in files if cf not in self.mtimes]
+        if len(files) < 2 or self.workers <= 1:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for cf, st in zip(files, executor.map(self.stat_file, files)):
+                if st is not None:
+                    self.mtimes[cf] = datetime.fromtimestamp(st.st_mtime)
+
+    def stat_file(self, cf):
+        try:
+            return input_stat(cf)
+        except OSError:
+            return None
+
+    def filter_by_date(self, files, number_of_days=None, start=None, end=None):
+        # keeps files with a timestamp within number_of_days of now and strictly between start and end
+        if not number_of_days and not start:
+            return files
+        self.prefetch_timestamps(files)
+        now = datetime.now()
+        kept = list()
+        for cf in files:
+            try:
+                tstamp = self.timestamp(cf)
+            except OSError as e:
+                self.logger.info(f"Could not read modification time of {cf}: {e}. Discard this file")
+                continue
+            if number_of_days and (now - tstamp).days > number_of_days:
+                self.logger.debug(f"{cf} timestamp {tstamp} is older than {number_of_days} days, Discard this file")
+                continue
+            if start and not start < tstamp < end:
+                self.logger.debug(f"{cf} timestamp {tstamp} Not in range. Discard this file")
+                continue
+            self.logger.debug(f"{cf} timestamp {tstamp} fits in range. Use this file")
+            kept.append(cf)
+        self.logger.info(f"{len(kept)} of {len(files)} files in date range, using {self.timestamp_source} timestamps")
+        return kept
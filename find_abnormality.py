@@ -9,6 +9,7 @@ import time
 import json
 import logging 
 from analyse import AnalyseData
+from multi_config import MultiConfigRun
 
 
 
@@ -21,7 +22,8 @@ if __name__ == "__main__":
         "-j",
         "--input-json",
         required=True,
-        help="Path to input json file containing all input arguments"
+        nargs="+",
+        help="Path to input json file containing all input arguments. Several input jsons are analysed in one pass over the files"
     )
     args.add_argument(
         "-v",
@@ -29,15 +31,60 @@ if __name__ == "__main__":
         action = "store_true",
         help="verbose"
     )
+    args.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes used to analyse files in parallel, 0 uses all cores. Overrides workers in input json"
+    )
+    args.add_argument(
+        "-f",
+        "--follow",
+        action = "store_true",
+        help="Keep running and analyse rows appended to the input files, stop with Ctrl+C"
+    )
+    args.add_argument(
+        "-p",
+        "--poll-interval",
+        type=float,
+        default=None,
+        help="Seconds between checks for appended rows with --follow. Overrides poll_interval in input json"
+    )
+    args.add_argument(
+        "-s",
+        "--shard",
+        action = "store_true",
+        help="Analyse the input files together with workers on other hosts through shard_directory in input json"
+    )
+    args.add_argument(
+        "-m",
+        "--merge",
+        action = "store_true",
+        help="Merge the outputs of the shards analysed in shard_directory in input json"
+    )
     pargs = args.parse_args()
-    if not os.path.exists(pargs.input_json):
-        print("Input json not found. check path")
-        sys.exit(1)
+    for input_json in pargs.input_json:
+        if not os.path.exists(input_json):
+            print(f"Input json {input_json} not found. check path")
+            sys.exit(1)
     
     loglevel = logging.INFO
     if pargs.verbose:
         loglevel = logging.DEBUG
     
-    analyse = AnalyseData(pargs.input_json, loglevel)
-    analyse.call_analysis(pargs.input_json)
- 
+    if len(pargs.input_json) > 1:
+        if pargs.follow or pargs.shard or pargs.merge:
+            print("--follow, --shard and --merge take one input json")
+            sys.exit(1)
+        MultiConfigRun(pargs.input_json, loglevel, pargs.workers).run()
+    else:
+        analyse = AnalyseData(pargs.input_json[0], loglevel, pargs.workers)
+        if pargs.follow:
+            analyse.follow(pargs.poll_interval)
+        elif pargs.shard:
+            analyse.run_shards()
+        elif pargs.merge:
+            analyse.merge_shards()
+        else:
+            analyse.call_analysis()
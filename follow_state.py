@@ -0,0 +1,70 @@
+import os
+import pickle
+import logging
+
+# bytes read backwards from the end of a growing file to find its last complete line
+TAIL_BYTES = 65536
+
+
+class FollowState(object):
+    # Per file state of --follow, saved in a pickle so a restarted run resumes where it stopped:
+    # the byte offset up to which the file is analysed, its header, the row number of the next row,
+    # and the rows carried over to the next poll (the rows before and after abnormalities and the
+    # last row, which the first new row is compared with for state changes).
+
+    def __init__(self, state_file):
+        self.logger = logging.getLogger('common')
+        self.state_file = state_file
+        self.entries = dict()
+        if os.path.exists(state_file):
+            try:
+                with open(state_file, "rb") as f:
+                    self.entries = pickle.load(f)
+                self.logger.info(f"Resuming {len(self.entries)} followed files from {state_file}")
+            except Exception as e:
+                self.logger.warning(f"Could not read follow state {state_file}, reading files from the start: {e}")
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        tmpfile = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmpfile, "wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, self.state_file)
+
+    def get(self, cf):
+        return self.entries.get(os.path.abspath(cf), None)
+
+    def start(self, cf, skipped, header, skip=False):
+        # state of a file read for the first time, analysis starts after the header line.
+        # None when the header line is not completely written yet
+        with open(cf, "rb") as f:
+            for _ in range(skipped + 1):
+                line = f.readline()
+            offset = f.tell()
+        if not line.endswith(b"\n"):
+            return None
+        entry = {"offset": offset, "header": header, "next_row": 0, "carry": None, "pending": 0, "skip": skip}
+        self.entries[os.path.abspath(cf)] = entry
+        return entry
+
+    def finish(self, cf):
+        # a file analysed completely, it is not read again
+        self.entries[os.path.abspath(cf)] = {"offset": 0, "header": list(), "next_row": 0, "carry": None,
+                                             "pending": 0, "skip": True}
+
+    def reset(self, cf):
+        self.entries.pop(os.path.abspath(cf), None)
+
+    def complete_end(self, cf, offset, size):
+        # offset after the last complete line between offset and size, a line being written is left for later
+        with open(cf, "rb") as f:
+            end = size
+            while end > offset:
+                start = max(offset, end - TAIL_BYTES)
+                f.seek(start)
+                block = f.read(end - start)
+                pos = block.rfind(b"\n")
+                if pos >= 0:
+                    return start + pos + 1
+                end = start
+        return offset
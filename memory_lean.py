@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_integer_dtype
+
+
+def filename_column(cf, nrows):
+    # one byte per row instead of a copy of the path
+    return pd.Categorical.from_codes(np.zeros(nrows, dtype=np.int8), categories=[cf])
+
+
+def compact_frame(df, skip=("Local Computer Time", "filename")):
+    # Downcasts the numeric columns of df where no value changes: float64 to float32 when every value
+    # converts back exactly, integer columns holding only 0 and 1 to bool, other integer columns to
+    # the smallest integer type. Decimal readings like 20.251 have no exact float32 and stay float64.
+    # Returns the columns changed to bool, expand_frame turns them back into 0 and 1.
+    bools = list()
+    for col in df.columns:
+        if col in skip or df.shape[0] == 0:
+            continue
+        dtype = df[col].dtype
+        if dtype == np.float64:
+            values = df[col].to_numpy()
+            with np.errstate(over="ignore"):
+                narrow = values.astype(np.float32)
+            if np.array_equal(narrow.astype(np.float64), values, equal_nan=True):
+                df[col] = narrow
+        elif isinstance(dtype, np.dtype) and is_integer_dtype(dtype) and dtype != np.uint64:
+            values = df[col].to_numpy()
+            if values.min() >= 0 and values.max() <= 1:
+                df[col] = values.astype(bool)
+                bools.append(col)
+            else:
+                df[col] = pd.to_numeric(df[col], downcast="integer")
+    return bools
+
+
+def align_dtypes(first, second):
+    # the same column can be compacted differently in two chunks, both are cast to a type holding
+    # the values of either, as concat would otherwise give object columns
+    for col in second.columns:
+        if col not in first.columns:
+            continue
+        a, b = first[col].dtype, second[col].dtype
+        if a == b or not (isinstance(a, np.dtype) and isinstance(b, np.dtype)):
+            continue
+        if a.kind in "biuf" and b.kind in "biuf":
+            target = np.result_type(a, b)
+            if a != target:
+                first = first.astype({col: target})
+            if b != target:
+                second = second.astype({col: target})
+    return first, second
+
+
+def expand_frame(df, bools=()):
+    # dtypes as read without memory_lean, used for the output csvs
+    if df.empty:
+        return df
+    types = dict()
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            types[col] = dtype.categories.dtype
+        elif (dtype == bool and col in bools) or (isinstance(dtype, np.dtype) and dtype.kind in "iu" and dtype != np.int64):
+            types[col] = np.int64
+        elif dtype == np.float32:
+            types[col] = np.float64
+    return df.astype(types) if types else df
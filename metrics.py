@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import pstats
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def process_peak_rss_mb():
+    # Peak resident set size of this process since it started, None where getrusage is not available.
+    # It is a high-water mark of the process, not of a file or stage: every file analysed after the
+    # largest one by the same process reports the same value.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def process_cpu_seconds():
+    # cpu time of this process and of the worker processes it has waited for
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def start_timer():
+    return (time.perf_counter(), time.process_time())
+
+
+def new_stage():
+    return {"wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "bytes": 0, "matched": 0}
+
+
+def add_stage(stages, stage, start, rows=0, nbytes=0, matched=0):
+    # adds the wall and cpu time since start (from start_timer) and the counts to stages[stage]
+    wall, cpu = start
+    entry = stages.setdefault(stage, new_stage())
+    entry["wall_seconds"] += time.perf_counter() - wall
+    entry["cpu_seconds"] += time.process_time() - cpu
+    entry["rows"] += rows
+    entry["bytes"] += nbytes
+    entry["matched"] += matched
+    return entry
+
+
+def merge_stages(total, stages):
+    for stage, entry in stages.items():
+        total_entry = total.setdefault(stage, new_stage())
+        for key, value in entry.items():
+            total_entry[key] = total_entry.get(key, 0) + value
+    return total
+
+
+def with_rates(stages):
+    # copy of stages with rows_per_second added
+    return {stage: {**entry, "rows_per_second": entry["rows"] / entry["wall_seconds"] if entry["wall_seconds"] else None}
+            for stage, entry in stages.items()}
+
+
+def write_metrics(path, metrics):
+    tmpfile = f"{path}.{os.getpid()}.tmp"
+    with open(tmpfile, "w") as f:
+        json.dump(metrics, f, indent=4, default=str)
+    os.replace(tmpfile, path)
+
+
+def profile_call(outbase, memory, func, *args):
+    # Runs func under cProfile, and tracemalloc when memory is set. Writes outbase.prof (for
+    # snakeviz / pstats), outbase_profile.txt with the top functions by cumulative time and,
+    # with memory, outbase_memory.txt with the lines allocating most memory.
+    logger = logging.getLogger('common')
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        profiler.dump_stats(outbase + ".prof")
+        with open(outbase + "_profile.txt", "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+        logger.info(f"Profile saved to {outbase}.prof and {outbase}_profile.txt")
+        if memory:
+            with open(outbase + "_memory.txt", "w") as f:
+                f.write(f"Peak traced memory: {peak/1e6:.1f} MB, still allocated: {current/1e6:.1f} MB\n")
+                for stat in snapshot.statistics("lineno")[:40]:
+                    f.write(f"{stat}\n")
+            logger.info(f"Memory profile saved to {outbase}_memory.txt, peak traced memory {peak/1e6:.1f} MB")
@@ -0,0 +1,214 @@
+import sys
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from analyse import AnalyseData
+from compressed_input import input_size
+from metrics import start_timer, add_stage, merge_stages, process_peak_rss_mb
+
+# input json keys and AnalyseData attributes of the settings used to read the files
+READ_SETTINGS = {"header_start_row": "skiprows", "chunk_size": "chunk_size", "csv_engine": "csv_engine",
+                 "typed_columns": "typed_columns", "memory_lean": "memory_lean",
+                 "sidecar_directory": "sidecar", "sidecar_format": "sidecar",
+                 "dedupe_rows": "row_dedup", "dedupe_max_keys": "row_dedup", "dedupe_spill_directory": "row_dedup"}
+
+# run owned by a worker process of the pool used in MultiConfigRun.run
+_worker_run = None
+
+
+def _init_worker(run):
+    global _worker_run
+    _worker_run = run
+    run.set_logging()
+
+
+def _analyse_file_worker(cf):
+    return _worker_run.analyse_file(cf)
+
+
+class MultiConfigRun(object):
+    # Several input jsons analysed in one pass over the data. Each file is read once with the
+    # columns any of the configs needs, and the rules of every config that has the file as input
+    # are evaluated on the same chunks. Every config keeps its own output directory, log, outputs
+    # and metrics. Files are read with the read settings of the first config.
+
+    def __init__(self, input_jsons, loglevel, workers=None):
+        self.logger = logging.getLogger('common')
+        self.loglevel = loglevel
+        self.analysers = list()
+        self.set_logging()
+        self.analysers = [AnalyseData(input_json, loglevel, workers, logger_name=f"common.config{i}")
+                          for i, input_json in enumerate(input_jsons)]
+        outdirs = [analyser.outdir for analyser in self.analysers]
+        if len(set(outdirs)) < len(outdirs):
+            self.logger.error(f"The input jsons must have different output_directory values, got {outdirs}")
+            sys.exit(-1)
+        self.reader = self.analysers[0]
+        self.workers = self.reader.workers
+        self.input_files = list()
+        for input_json, analyser in zip(input_jsons, self.analysers):
+            self.logger.info(f"{input_json}: results in {analyser.outdir}")
+            for key, attr in READ_SETTINGS.items():
+                if analyser.jsondata.get(key, None) != self.reader.jsondata.get(key, None):
+                    analyser.logger.warning(f"{key} {analyser.jsondata.get(key, None)} is ignored, files are read with "
+                                            f"{key} {self.reader.jsondata.get(key, None)} of {input_jsons[0]}")
+                setattr(analyser, attr, getattr(self.reader, attr))
+            if analyser.row_dedup and analyser.result_cache:
+                analyser.logger.warning("cache_directory is not used with dedupe_rows, results depend on the files read before")
+                analyser.result_cache = None
+            if analyser.time_window:
+                analyser.logger.warning("Files are selected on the time window, but all their rows are analysed")
+            if analyser.profile_file:
+                analyser.logger.warning("profile_file is not supported when analysing several input jsons")
+
+    def set_logging(self):
+        # the console for all configs, each config logs to its own file as well
+        logging.basicConfig(level=self.loglevel,
+                            format="%(asctime)s [%(levelname)s] %(message)s",
+                            handlers=[logging.StreamHandler()])
+        for analyser in self.analysers:
+            analyser.add_log_file()
+
+    def run(self):
+        # files of all configs in the order they are found, each analysed for the configs it is an input of
+        cfiles = dict()
+        for analyser in self.analysers:
+            start = start_timer()
+            files = analyser.get_files(analyser.jsondata) or list()
+            add_stage(analyser.stage_times, "discovery", start, rows=len(files))
+            analyser.logger.info(files)
+            self.input_files.append(set(files))
+            cfiles.update(dict.fromkeys(files))
+        cfiles = list(cfiles)
+        self.logger.info(f"Analysing {len(cfiles)} files for {len(self.analysers)} input jsons")
+
+        sinks = [analyser.open_sinks() for analyser in self.analysers]
+        totals = [analyser.new_totals() for analyser in self.analysers]
+        pbar = tqdm(range(len(cfiles)), desc="\nProgress on number of files processed", ncols=100)
+        for results in self.iter_file_results(cfiles, pbar):
+            for i, result in results.items():
+                self.analysers[i].add_result(result, sinks[i], totals[i])
+        pbar.close()
+
+        found = False
+        for i, analyser in enumerate(self.analysers):
+            if not self.input_files[i]:
+                analyser.save_metrics()
+                continue
+            analyser.end_results(totals[i], len(self.input_files[i]))
+            found = analyser.finish_run(sinks[i]) or found
+        if not found:
+            sys.exit(-1)
+
+    def iter_file_results(self, cfiles, pbar):
+        # {config index: result} of each file in input order
+        if self.workers <= 1 or len(cfiles) <= 1 or self.reader.row_dedup:
+            for cf in cfiles:
+                yield self.analyse_file(cf)
+                pbar.update()
+            return
+
+        done = dict()
+        next_idx = 0
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            futures = {executor.submit(_analyse_file_worker, cf): idx for idx, cf in enumerate(cfiles)}
+            for future in as_completed(futures):
+                pbar.update()
+                done[futures[future]] = future.result()
+                while next_idx in done:
+                    yield done.pop(next_idx)
+                    next_idx += 1
+
+    def analyse_file(self, cf):
+        results = dict()
+        scans = dict()
+        for i, analyser in enumerate(self.analysers):
+            if cf not in self.input_files[i]:
+                continue
+            analyser.timings = dict()
+            results[i] = analyser.new_result(cf)
+            analyser.logger.info(f"\n----------------Analysing file {cf}--------------------- ")
+            try:
+                cache_entry, cached = analyser.lookup_cache(cf)
+            except OSError as e:
+                analyser.logger.error(f"Error reading file {cf}: {e}")
+                continue
+            if cached is not None:
+                results[i] = cached
+            else:
+                scans[i] = {"cache_entry": cache_entry, "scan": None}
+        if scans:
+            self.scan_file(cf, scans, results)
+        for i, result in results.items():
+            result["timings"] = self.analysers[i].timings
+            result["process_peak_rss_mb"] = process_peak_rss_mb()
+        return results
+
+    def scan_file(self, cf, scans, results):
+        # reads cf once and feeds every chunk to the scans of the configs
+        try:
+            _, header = self.reader.read_header(cf)
+        except Exception as e:
+            for i in scans:
+                self.analysers[i].logger.error(f"Error parsing file {cf}: {e}")
+            return
+        for i in list(scans):
+            analyser = self.analysers[i]
+            if not analyser.check_header(cf, header):
+                del scans[i]
+                continue
+            scans[i]["columns"] = ["filename"] + [col for col in header if col in analyser.load_columns_from_csv]
+        if not scans:
+            return
+
+        parse = dict()
+        self.reader.bool_columns = set()
+        try:
+            start = start_timer()
+            chunks = self.reader.read_chunks(cf, [col for col in header if any(col in x["columns"] for x in scans.values())])
+            chunk = next(chunks)
+            add_stage(parse, "parse", start, rows=chunk.shape[0], nbytes=input_size(cf))
+        except Exception as e:
+            for i in scans:
+                self.analysers[i].logger.error(f"Error parsing file {cf}: {e}")
+            return
+        for i, entry in scans.items():
+            entry["selected"] = self.analysers[i].select_columns(cf, entry["columns"])
+
+        while chunk is not None:
+            try:
+                start = start_timer()
+                nxt = next(chunks, None)
+                add_stage(parse, "parse", start, rows=0 if nxt is None else nxt.shape[0])
+            except Exception as e:
+                for i in scans:
+                    self.analysers[i].logger.error(f"Error parsing file {cf}: {e}")
+                return
+            for i, entry in list(scans.items()):
+                analyser = self.analysers[i]
+                rules, threshold_cols, sc_specs, detectors = entry["selected"]
+                scan = entry["scan"]
+                try:
+                    # the chunk is analysed as it is by scan_chunks, carrying rows over to the next chunk
+                    step = analyser.scan_chunks(chunk[entry["columns"]], iter(()), rules, sc_specs,
+                                                None if scan is None else scan["carry"],
+                                                0 if scan is None else scan["pending"],
+                                                final=nxt is None, detectors=detectors)
+                except Exception as e:
+                    analyser.logger.error(f"Error parsing file {cf}: {e}")
+                    del scans[i]
+                    continue
+                entry["scan"] = analyser.merge_scan(scan, step)
+            chunk = nxt
+
+        for i, entry in scans.items():
+            analyser = self.analysers[i]
+            # the file is parsed once for all configs, each of them shows the time of parsing it
+            merge_stages(analyser.timings, parse)
+            analyser.bool_columns = set(self.reader.bool_columns)
+            analyser.collect_scan(results[i], cf, entry["scan"], *entry["selected"])
+            if entry["cache_entry"]:
+                analyser.result_cache.put(entry["cache_entry"], results[i])
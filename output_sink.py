@@ -0,0 +1,81 @@
+import os
+import csv
+import logging
+import numpy as np
+import pandas as pd
+
+
+class CsvSink(object):
+    # Append-only csv output. The file is created on the first write with extra blank lines on top
+    # (same layout as Common.prepend_extra_lines_csv), later writes append only rows not seen before.
+    # With append an existing file is continued, its header is kept and rows are added after its rows.
+
+    def __init__(self, csv_file, number_of_extra_lines=4, append=False):
+        self.logger = logging.getLogger('common')
+        self.csv_file = csv_file
+        self.number_of_extra_lines = number_of_extra_lines
+        self.columns = None
+        self.row_keys = set()
+        self.rows_written = 0
+        if append:
+            self.columns = self.read_columns()
+
+    def read_columns(self):
+        # header of an existing output file, None when there is no file or no header line in it yet
+        if not os.path.exists(self.csv_file):
+            return None
+        with open(self.csv_file, "r", newline="") as f:
+            for _ in range(self.number_of_extra_lines):
+                f.readline()
+            line = f.readline()
+        if not line.endswith("\n"):
+            return None
+        self.logger.info(f"Appending to {self.csv_file}")
+        return next(csv.reader([line]))
+
+    def write(self, df):
+        if df.empty:
+            return 0
+
+        header = self.columns is None
+        if header:
+            self.columns = list(df.columns)
+        else:
+            unknown = [col for col in df.columns if col not in self.columns]
+            if unknown:
+                self.extend_header(unknown)
+            df = df.reindex(columns=self.columns)
+
+        # 64 bit hash of every row replaces drop_duplicates over the whole output
+        keep = np.zeros(df.shape[0], dtype=bool)
+        for i, key in enumerate(pd.util.hash_pandas_object(df, index=False).tolist()):
+            if key not in self.row_keys:
+                self.row_keys.add(key)
+                keep[i] = True
+
+        with open(self.csv_file, "w" if header else "a") as f:
+            if header:
+                f.write(self.number_of_extra_lines * "\n")
+            df[keep].to_csv(f, header=header, index=False)
+
+        self.rows_written += int(keep.sum())
+        return int(keep.sum())
+
+    def extend_header(self, columns):
+        # rows already written get empty values for the new columns, like pd.concat would give.
+        # This rewrites the file, which only happens when a file brings columns not seen before
+        self.logger.info(f"Adding columns {columns} to {self.csv_file}")
+        tmpfile = self.csv_file + ".tmp"
+        reader = pd.read_csv(self.csv_file,
+                             skiprows=self.number_of_extra_lines,
+                             dtype=str,
+                             keep_default_na=False,
+                             chunksize=100000)
+        with open(tmpfile, "w") as f:
+            f.write(self.number_of_extra_lines * "\n")
+            header = True
+            for chunk in reader:
+                chunk.reindex(columns=self.columns + columns).to_csv(f, header=header, index=False)
+                header = False
+        os.replace(tmpfile, self.csv_file)
+        self.columns += columns
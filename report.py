@@ -0,0 +1,195 @@
+import os
+import logging
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from HTMLHelper import HTMLHelper
+
+TIME_COLUMN = "Local Computer Time"
+
+
+def minmax_positions(values, n_buckets):
+    # positions of the minimum and the maximum in each of n_buckets buckets of consecutive values,
+    # missing values are never selected. Unlike LTTB this always keeps the extremes, spikes survive.
+    valid = ~np.isnan(values)
+    n = values.shape[0]
+    if n <= 2 * n_buckets:
+        return np.flatnonzero(valid)
+    buckets = np.arange(n) * n_buckets // n
+    positions = list()
+    for sign in (1, -1):
+        key = np.where(valid, sign * values, np.inf)
+        order = np.lexsort((key, buckets))
+        first = np.r_[True, buckets[order][1:] != buckets[order][:-1]]
+        positions.append(order[first])
+    positions = np.unique(np.concatenate(positions))
+    return positions[valid[positions]]
+
+
+def sample_points(df, columns, n_points):
+    # {column: DataFrame of Local Computer Time and value} with at most 2 * n_points rows per column
+    points = dict()
+    for col in columns:
+        values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+        keep = minmax_positions(values, n_points)
+        points[col] = pd.DataFrame({TIME_COLUMN: df[TIME_COLUMN].to_numpy()[keep], "value": values[keep]})
+    return points
+
+
+def compact_points(frames, n_points):
+    # time ordered min/max downsampling of the points of several files or chunks
+    df = pd.concat(frames, axis=0, ignore_index=True)
+    if df.shape[0] <= 2 * n_points:
+        return df
+    df = df.iloc[np.argsort(df[TIME_COLUMN].to_numpy(dtype=str), kind="stable")]
+    return df.iloc[minmax_positions(df["value"].to_numpy(dtype="float64"), n_points)]
+
+
+def merge_points(total, points, n_points):
+    # adds points from sample_points to total, keeping at most about 2 * n_points per column
+    for col, df in points.items():
+        if col in total:
+            total[col] = compact_points([total[col], df], n_points)
+        else:
+            total[col] = df
+    return total
+
+
+def render_figure(spec):
+    # html of one column: downsampled values, every anomaly point (or a downsampled set when
+    # there are more than the report allows) and the thresholds of the rules on the column
+    col, series, anomalies, thresholds, note = spec
+    fig = go.Figure()
+    series = series.assign(x=to_time(series[TIME_COLUMN])).sort_values("x", kind="stable")
+    fig.add_trace(go.Scattergl(x=series["x"], y=series["value"], mode="lines", name=col, line=dict(width=1)))
+    if anomalies is not None and not anomalies.empty:
+        fig.add_trace(go.Scattergl(x=to_time(anomalies[TIME_COLUMN]), y=anomalies["value"], mode="markers",
+                                   name="abnormal", marker=dict(color="red", size=5)))
+    for label, value in thresholds:
+        fig.add_hline(y=value, line_dash="dash", line_color="orange", annotation_text=label)
+    return HTMLHelper().figure_to_html(fig, col + note, height=500, width=1400)
+
+
+def to_time(times):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        parsed = pd.to_datetime(times, errors="coerce", format="mixed")
+    return times if parsed.isna().all() else parsed
+
+
+class AnomalyReport(object):
+    # HTML report of a run built from the per file results: tables of counts, the first rows of
+    # the outputs with summary statistics of their columns, and a figure per column of interest.
+    # Figures hold at most about 2 * points values and max_anomaly_points abnormal points per
+    # column, tables at most table_rows rows, the report size does not grow with the input.
+
+    def __init__(self, report_file, points=2000, max_anomaly_points=5000, table_rows=100, workers=1):
+        self.logger = logging.getLogger('common')
+        self.report_file = report_file
+        self.points = points
+        self.max_anomaly_points = max_anomaly_points
+        self.table_rows = table_rows
+        self.workers = max(workers, 1)
+        self.series = dict()
+        self.anomalies = dict()
+        self.anomaly_counts = dict()
+        self.files = list()
+        self.rule_hits = dict()
+        self.tables = {"threshold": list(), "state_change": list()}
+        self.table_counts = {"threshold": 0, "state_change": 0}
+        self.column_stats = {"threshold": dict(), "state_change": dict()}
+
+    def add(self, result):
+        merge_points(self.series, result.get("report_series", dict()), self.points)
+        for col, df in result.get("report_anomalies", dict()).items():
+            self.anomaly_counts[col] = self.anomaly_counts.get(col, 0) + result.get("report_anomaly_counts", dict()).get(col, df.shape[0])
+            merge_points(self.anomalies, {col: df}, self.max_anomaly_points // 2)
+        for name, count in result.get("rule_hits", dict()).items():
+            self.rule_hits[name] = self.rule_hits.get(name, 0) + count
+        self.files.append({"filename": result["filename"],
+                           "threshold rows": result["threshold"].shape[0],
+                           "state change rows": result["state_change"].shape[0],
+                           "state changes": result["toggles"],
+                           "cached": result["cached"]})
+        for kind in self.tables:
+            self.add_rows(kind, result[kind])
+
+    def add_rows(self, kind, df):
+        if df.empty:
+            return
+        self.table_counts[kind] += df.shape[0]
+        shown = sum(x.shape[0] for x in self.tables[kind])
+        if shown < self.table_rows:
+            self.tables[kind].append(df.head(self.table_rows - shown))
+        # count, min, max and sum of the numeric columns over all rows
+        stats = self.column_stats[kind]
+        for col in df.columns:
+            if col in [TIME_COLUMN, "filename"]:
+                continue
+            values = pd.to_numeric(df[col], errors="coerce").dropna()
+            if values.empty:
+                continue
+            entry = stats.setdefault(col, {"count": 0, "min": np.inf, "max": -np.inf, "sum": 0.0})
+            entry["count"] += values.shape[0]
+            entry["min"] = min(entry["min"], values.min())
+            entry["max"] = max(entry["max"], values.max())
+            entry["sum"] += values.sum()
+
+    def summary_table(self, kind):
+        rows = [{"column": col, "rows": x["count"], "min": x["min"], "max": x["max"], "mean": x["sum"] / x["count"]}
+                for col, x in self.column_stats[kind].items()]
+        return pd.DataFrame(rows)
+
+    def figure_specs(self, thresholds):
+        specs = list()
+        for col, series in self.series.items():
+            anomalies = self.anomalies.get(col, None)
+            count = self.anomaly_counts.get(col, 0)
+            note = ""
+            if anomalies is not None and anomalies.shape[0] < count:
+                note = f" ({count} abnormal rows, {anomalies.shape[0]} shown)"
+            elif count:
+                note = f" ({count} abnormal rows)"
+            specs.append((col, series, anomalies, thresholds.get(col, list()), note))
+        return specs
+
+    def render_figures(self, specs):
+        if self.workers <= 1 or len(specs) <= 1:
+            return [render_figure(spec) for spec in specs]
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(specs))) as executor:
+            return list(executor.map(render_figure, specs))
+
+    def write(self, title, run_summary, transitions, thresholds, outputs):
+        helper = HTMLHelper()
+        html = helper.dataframe_to_html(pd.DataFrame([run_summary]), title="Summary")
+        if self.rule_hits:
+            html += helper.dataframe_to_html(pd.DataFrame([{"rule": k, "rows matched": v} for k, v in self.rule_hits.items()]),
+                                             title="Threshold rules")
+        if transitions:
+            html += helper.dataframe_to_html(pd.DataFrame([{"column": col, "from": a, "to": b, "count": n}
+                                                           for col, counts in transitions.items()
+                                                           for (a, b), n in counts.items()]),
+                                             title="State changes")
+        html += "".join(self.render_figures(self.figure_specs(thresholds)))
+
+        files = pd.DataFrame(self.files)
+        if not files.empty:
+            files = files[(files["threshold rows"] > 0) | (files["state change rows"] > 0)]
+            title_files = f"Files with abnormalities: {files.shape[0]} of {len(self.files)}"
+            if files.shape[0] > self.table_rows:
+                files = files.sort_values("threshold rows", ascending=False, kind="stable").head(self.table_rows)
+                title_files += f", {self.table_rows} with most threshold rows shown"
+            html += helper.dataframe_to_html(files, title=title_files)
+
+        for kind, label in [("threshold", "Threshold crossings"), ("state_change", "State changes")]:
+            if not self.table_counts[kind]:
+                continue
+            html += helper.dataframe_to_html(self.summary_table(kind), title=f"{label}: summary of {self.table_counts[kind]} rows")
+            shown = pd.concat(self.tables[kind], axis=0)
+            html += helper.dataframe_to_html(shown, title=f"{label}: first {shown.shape[0]} of {self.table_counts[kind]} rows, all rows in {outputs[kind]}")
+
+        helper.write_to_html(helper.browser_compatibility(helper.add_page_headers(html, title)), self.report_file)
+        self.logger.info(f"Report saved to {self.report_file}, {os.path.getsize(self.report_file)/1e6:.1f} MB")
@@ -0,0 +1,65 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+
+from compressed_input import input_stat
+
+
+class ResultCache(object):
+    # Analysis results of single files kept in a directory between runs. Entries are keyed on the
+    # file path, size and modification time and on the part of the input json that changes results.
+
+    def __init__(self, cache_dir, config, max_size_mb=1024):
+        self.logger = logging.getLogger('common')
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1e6
+        self.config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, cf):
+        st = input_stat(cf)
+        key = f"{os.path.abspath(cf)}|{st.st_size}|{st.st_mtime_ns}|{self.config_hash}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pkl")
+
+    def get(self, entry):
+        if not os.path.exists(entry):
+            return None
+        try:
+            with open(entry, "rb") as f:
+                result = pickle.load(f)
+            # entries are evicted least recently used first
+            os.utime(entry)
+        except Exception as e:
+            self.logger.warning(f"Could not read cache entry {entry}: {e}")
+            return None
+        return result
+
+    def put(self, entry, result):
+        tmpfile = f"{entry}.{os.getpid()}.tmp"
+        try:
+            with open(tmpfile, "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, entry)
+        except Exception as e:
+            self.logger.warning(f"Could not write cache entry {entry}: {e}")
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def evict(self):
+        entries = list()
+        for dentry in os.scandir(self.cache_dir):
+            if dentry.name.endswith(".pkl"):
+                st = dentry.stat()
+                entries.append((st.st_mtime, st.st_size, dentry.path))
+        total = sum(x[1] for x in entries)
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        if removed:
+            self.logger.info(f"Removed {removed} entries from cache {self.cache_dir}, cache size is now {total/1e6} MB")
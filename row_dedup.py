@@ -0,0 +1,71 @@
+import os
+import shutil
+import logging
+import tempfile
+import weakref
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_integer_dtype, is_bool_dtype
+
+
+def row_keys(df, skip=("filename",)):
+    # 64 bit hash of each row over all columns but the file name. Columns are hashed in name order
+    # and integer columns as float64, so the same row in a file where the column has missing values
+    # (and is read as float64) gets the same key.
+    columns = sorted(col for col in df.columns if col not in skip)
+    types = {col: np.float64 for col in columns
+             if isinstance(df[col].dtype, np.dtype) and (is_integer_dtype(df[col].dtype) or is_bool_dtype(df[col].dtype))}
+    frame = df[columns].astype(types) if types else df[columns]
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+class RowKeySet(object):
+    # Row keys seen so far in sorted uint64 arrays (runs), 8 bytes per key instead of about 70 in a
+    # python set. Every batch of new keys is a run, runs of similar size are merged, so there are
+    # about log2(keys) runs, oldest and largest first. Beyond max_keys keys in memory the oldest run
+    # is written to spill_directory and memory mapped from there, or without a spill directory it is
+    # dropped: then only repeats of the max_keys most recent keys are found.
+
+    def __init__(self, max_keys=100000000, spill_directory=None):
+        self.logger = logging.getLogger('common')
+        self.max_keys = max(int(max_keys), 1)
+        self.runs = list()
+        self.spilled = list()
+        self.spill_dir = None
+        self.forgotten = 0
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix="row_keys_", dir=spill_directory)
+            weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    def add(self, keys):
+        # True for the keys not seen before, of keys repeated within the batch the first one
+        uniq, first = np.unique(keys, return_index=True)
+        seen = np.zeros(uniq.shape[0], dtype=bool)
+        for run in self.spilled + self.runs:
+            pos = np.minimum(np.searchsorted(run, uniq), run.shape[0] - 1)
+            seen |= run[pos] == uniq
+        new = np.zeros(keys.shape[0], dtype=bool)
+        new[first[~seen]] = True
+        if not seen.all():
+            self.runs.append(uniq[~seen])
+            self.compact()
+        return new
+
+    def compact(self):
+        while len(self.runs) > 1 and self.runs[-2].shape[0] <= 2 * self.runs[-1].shape[0]:
+            newest = self.runs.pop()
+            merged = np.concatenate([self.runs.pop(), newest])
+            merged.sort()
+            self.runs.append(merged)
+        while len(self.runs) > 1 and sum(run.shape[0] for run in self.runs) > self.max_keys:
+            oldest = self.runs.pop(0)
+            if self.spill_dir:
+                path = os.path.join(self.spill_dir, f"run_{len(self.spilled):05d}.npy")
+                np.save(path, oldest)
+                self.spilled.append(np.load(path, mmap_mode="r"))
+            else:
+                if not self.forgotten:
+                    self.logger.warning(f"More than {self.max_keys} row keys, repeats of older rows are not found "
+                                        "any more, set dedupe_spill_directory to keep all keys")
+                self.forgotten += oldest.shape[0]
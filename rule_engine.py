@@ -0,0 +1,152 @@
+import numpy as np
+
+OPERATORS = {
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    "==": np.equal,
+    "=": np.equal,
+    "!=": np.not_equal,
+}
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Rule(object):
+    # leaf of a threshold rule tree: column_of_interest <operator> value
+
+    def __init__(self, column, operator, value, name=None):
+        if operator not in OPERATORS:
+            raise RuleError(f"Invalid operator {operator} for column {column}, valid operators are {list(OPERATORS)}")
+        try:
+            self.value = float(value)
+        except (TypeError, ValueError):
+            raise RuleError(f"Invalid value {value} for column {column}, value must be a number")
+        self.column = column
+        self.operator = operator
+        self.raw_value = value
+        self.name = name if name else self.expression()
+
+    def columns(self):
+        return [self.column]
+
+    def leaves(self):
+        return [self]
+
+    def matchers(self):
+        return [self]
+
+    def bind(self, columns):
+        return self if self.column in columns else None
+
+    def expression(self):
+        return f"`{self.column}` {self.operator} {self.raw_value}"
+
+    def evaluate(self, df, masks):
+        values = df[self.column].to_numpy(dtype="float64", na_value=np.nan)
+        mask = OPERATORS[self.operator](values, self.value)
+        masks[self.name] = mask
+        return mask
+
+
+class RuleGroup(object):
+    # "and" / "or" of rules or other groups
+
+    def __init__(self, op, children):
+        self.op = op
+        self.children = children
+
+    def columns(self):
+        return [col for child in self.children for col in child.columns()]
+
+    def leaves(self):
+        return [leaf for child in self.children for leaf in child.leaves()]
+
+    def matchers(self):
+        return [matcher for child in self.children for matcher in child.matchers()]
+
+    def bind(self, columns):
+        # Rules on columns missing from a file are left out of an "or", as if they were not configured.
+        # An "and" with such a rule cannot match and is left out as a whole.
+        children = [child.bind(columns) for child in self.children]
+        if self.op == "and" and None in children:
+            return None
+        children = [x for x in children if x is not None]
+        if not children:
+            return None
+        return RuleGroup(self.op, children)
+
+    def expression(self):
+        joiner = " & " if self.op == "and" else " | "
+        if len(self.children) == 1:
+            return self.children[0].expression()
+        return joiner.join(f"({child.expression()})" if isinstance(child, RuleGroup) else child.expression()
+                           for child in self.children)
+
+    def evaluate(self, df, masks):
+        combine = np.logical_and if self.op == "and" else np.logical_or
+        mask = self.children[0].evaluate(df, masks)
+        for child in self.children[1:]:
+            mask = combine(mask, child.evaluate(df, masks))
+        return mask
+
+
+class RuleNot(object):
+    # a row matched through a "not" is attributed to the "not", the rules below it did not match
+
+    def __init__(self, child, name=None):
+        self.child = child
+        self.given_name = name
+        self.name = name if name else self.expression()
+
+    def columns(self):
+        return self.child.columns()
+
+    def leaves(self):
+        return self.child.leaves()
+
+    def matchers(self):
+        return [self]
+
+    def bind(self, columns):
+        child = self.child.bind(columns)
+        return RuleNot(child, self.given_name) if child is not None else None
+
+    def expression(self):
+        return f"~({self.child.expression()})"
+
+    def evaluate(self, df, masks):
+        mask = np.logical_not(self.child.evaluate(df, masks))
+        masks[self.name] = mask
+        return mask
+
+
+def compile_rules(config):
+    # A list is the OR of its entries. A dictionary is either a rule with column_of_interest,
+    # operator, value and an optional name, or one of {"and": [...]}, {"or": [...]}, {"not": {...}}.
+    # Rules with an empty column_of_interest are ignored, None is returned when no rule is left.
+    if isinstance(config, list):
+        config = {"or": config}
+    if not isinstance(config, dict):
+        raise RuleError(f"Invalid threshold rule {config}")
+
+    if "and" in config or "or" in config:
+        op = "and" if "and" in config else "or"
+        if not isinstance(config[op], list):
+            raise RuleError(f"{op} needs a list of rules: {config}")
+        children = [x for x in (compile_rules(child) for child in config[op]) if x is not None]
+        return RuleGroup(op, children) if children else None
+
+    if "not" in config:
+        child = compile_rules(config["not"])
+        return RuleNot(child, config.get("name", None)) if child is not None else None
+
+    if "column_of_interest" not in config:
+        raise RuleError(f"Invalid threshold rule {config}")
+    if config["column_of_interest"] == "":
+        return None
+    return Rule(config["column_of_interest"], config.get("operator", "=="), config.get("value", None),
+                config.get("name", None))
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import socket
+import logging
+import threading
+from datetime import datetime
+
+
+class ShardCoordinator(object):
+    # Splits the input files of a run over workers on several hosts through a shared directory,
+    # without any other service. Layout of shard_dir:
+    #   plan.json                    the files of the run in shards of shard_size files, written by the first worker
+    #   leases/shard_NNNNN.lease     the worker analysing a shard, renewed every lease_timeout / 3 seconds
+    #   work/shard_NNNNN.<worker>    outputs of a shard being analysed
+    #   done/shard_NNNNN             outputs and summary.pkl of an analysed shard, renamed from work
+    #   leases/merge.lease           the worker merging the shards once all are done
+    #   merged.json                  the output directory of the merged run
+    # Files are only created with os.link or renamed, which are atomic on local and NFS mounts, so of
+    # two workers racing for a lease exactly one gets it. A lease not renewed for lease_timeout seconds
+    # belongs to a dead worker and is taken over. The clocks of the hosts must be synchronised.
+
+    def __init__(self, shard_dir, shard_size=10, lease_timeout=600, poll_interval=10, worker_id=None):
+        self.logger = logging.getLogger('common')
+        self.shard_dir = shard_dir
+        self.shard_size = max(int(shard_size), 1)
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shard_files = list()
+        self.lost = set()
+        self.heartbeats = dict()
+        for sub in ["leases", "work", "done"]:
+            os.makedirs(os.path.join(shard_dir, sub), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.shard_dir, *parts)
+
+    def shard_name(self, shard):
+        return f"shard_{shard:05d}"
+
+    def create_exclusive(self, path, content):
+        # True when path did not exist and now holds content
+        tmpfile = f"{path}.{self.worker_id}.tmp"
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        try:
+            os.link(tmpfile, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmpfile)
+
+    def plan(self, find_files):
+        # the shards of the run, the first worker finds the files, later workers read its plan
+        plan_file = self.path("plan.json")
+        if not os.path.exists(plan_file):
+            files = find_files()
+            shards = [files[i:i + self.shard_size] for i in range(0, len(files), self.shard_size)]
+            if self.create_exclusive(plan_file, json.dumps({"worker": self.worker_id, "shards": shards}, indent=4)):
+                self.logger.info(f"Planned {len(files)} files in {len(shards)} shards in {self.shard_dir}")
+        return self.load_plan()
+
+    def load_plan(self):
+        # the shards of an existing plan, None when no worker has planned the run
+        plan_file = self.path("plan.json")
+        if not os.path.exists(plan_file):
+            return None
+        with open(plan_file) as f:
+            plan = json.load(f)
+        self.shard_files = plan["shards"]
+        self.logger.info(f"Run planned by {plan['worker']}: {len(self.shard_files)} shards")
+        return self.shard_files
+
+    def is_done(self, shard):
+        return os.path.exists(self.path("done", self.shard_name(shard)))
+
+    def pending(self):
+        return [shard for shard in range(len(self.shard_files)) if not self.is_done(shard)]
+
+    def lease_content(self):
+        return json.dumps({"worker": self.worker_id, "acquired": datetime.now().isoformat()})
+
+    def lease_owner(self, lease):
+        try:
+            with open(lease) as f:
+                return json.load(f)["worker"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def lease_path(self, name):
+        return self.path("leases", name + ".lease")
+
+    def acquire(self, name):
+        # takes the lease name and renews it in a thread until released
+        lease = self.lease_path(name)
+        if not self.take_lease(lease, name):
+            return False
+        stop = threading.Event()
+        thread = threading.Thread(target=self.heartbeat, args=(name, stop), daemon=True)
+        thread.start()
+        self.heartbeats[name] = (stop, thread)
+        return True
+
+    def take_lease(self, lease, name):
+        if self.create_exclusive(lease, self.lease_content()):
+            return True
+        if not self.expired(lease):
+            return False
+        # only one of the workers finding the lease expired renames it away
+        stale = f"{lease}.expired.{self.worker_id}"
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        owner = self.lease_owner(stale)
+        if not self.expired(stale):
+            # renewed between the check and the rename, the owner is alive
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        if not self.create_exclusive(lease, self.lease_content()):
+            return False
+        self.logger.warning(f"Took over {name} from {owner}, its lease expired")
+        return True
+
+    def heartbeat(self, name, stop):
+        lease = self.lease_path(name)
+        while not stop.wait(self.lease_timeout / 3):
+            if self.lease_owner(lease) != self.worker_id:
+                self.logger.warning(f"Lost the lease of {name}")
+                self.lost.add(name)
+                return
+            os.utime(lease)
+
+    def shards(self):
+        # yields (shard, files) for every shard this worker gets a lease on, waits for the shards
+        # leased by other workers until they are done or their leases expire
+        while True:
+            pending = self.pending()
+            if not pending:
+                return
+            acquired = False
+            for shard in pending:
+                if self.is_done(shard) or not self.acquire(self.shard_name(shard)):
+                    continue
+                acquired = True
+                if self.is_done(shard):
+                    self.release(self.shard_name(shard))
+                    continue
+                yield shard, self.shard_files[shard]
+            if not acquired:
+                self.logger.info(f"Waiting for {len(pending)} shards analysed by other workers")
+                time.sleep(self.poll_interval)
+
+    def work_dir(self, shard):
+        work = self.path("work", f"{self.shard_name(shard)}.{self.worker_id}")
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+        return work
+
+    def finish(self, shard, work, summary):
+        # publishes the outputs of a shard, the first worker to finish a shard wins
+        with open(os.path.join(work, "summary.pkl"), "wb") as f:
+            pickle.dump(summary, f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(work, self.path("done", self.shard_name(shard)))
+        except OSError:
+            self.logger.warning(f"{self.shard_name(shard)} was finished by another worker, dropping this copy")
+            shutil.rmtree(work, ignore_errors=True)
+        self.release(self.shard_name(shard))
+
+    def release(self, name):
+        stop, thread = self.heartbeats.pop(name, (None, None))
+        if stop:
+            stop.set()
+            thread.join()
+        lease = self.lease_path(name)
+        if name not in self.lost and self.lease_owner(lease) == self.worker_id:
+            os.remove(lease)
+
+    def merged(self):
+        # output directory of the merged run, None until a worker has merged the shards
+        try:
+            with open(self.path("merged.json")) as f:
+                return json.load(f)["output_directory"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def merge_leases(self):
+        # yields once for the worker that gets the merge lease, waits while another worker merges
+        # and takes over when its lease expires
+        while self.merged() is None:
+            if self.acquire("merge"):
+                try:
+                    yield
+                finally:
+                    self.release("merge")
+                return
+            self.logger.info("Waiting for the shards to be merged by another worker")
+            time.sleep(self.poll_interval)
+
+    def finish_merge(self, outdir):
+        self.create_exclusive(self.path("merged.json"), json.dumps({"worker": self.worker_id, "output_directory": outdir}))
+
+    def done_shards(self):
+        # (shard, directory, summary) of the analysed shards in plan order
+        for shard in range(len(self.shard_files)):
+            done = self.path("done", self.shard_name(shard))
+            if not os.path.exists(done):
+                self.logger.warning(f"{self.shard_name(shard)} is not analysed, its files are missing from the merge")
+                continue
+            with open(os.path.join(done, "summary.pkl"), "rb") as f:
+                yield shard, done, pickle.load(f)
@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+
+from compressed_input import input_stat, csv_source
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# rows per chunk read from the csv while writing a sidecar when chunk_size is not set
+TRANSCODE_CHUNK_SIZE = 100000
+
+
+class SchemaChange(Exception):
+    # a chunk of the csv has columns of other types than the chunks before it, the sidecar is
+    # written again with these columns read as the types holding the values of both
+    def __init__(self, dtypes):
+        super().__init__(f"column types change within the file: {dtypes}")
+        self.dtypes = dtypes
+
+
+class ColumnarSidecar(object):
+    # Columnar copy (parquet or feather) of an input csv, written on first use into sidecar_dir.
+    # Later runs read only the columns they need from it. The size and modification time of the
+    # csv are stored in the sidecar and it is written again when they change. The csv is read and
+    # written a chunk at a time, the types of the columns are those of the first chunk, widened when
+    # later chunks need it.
+
+    def __init__(self, sidecar_dir, fmt="parquet", skiprows=4):
+        self.logger = logging.getLogger('common')
+        self.sidecar_dir = sidecar_dir
+        self.fmt = fmt
+        self.skiprows = skiprows
+        if pa is None:
+            self.logger.error("pyarrow is required for columnar sidecars, reading csv files instead")
+        elif self.fmt not in ["parquet", "feather"]:
+            self.logger.error(f"Invalid sidecar format {self.fmt}, use parquet or feather")
+            self.fmt = "parquet"
+        os.makedirs(self.sidecar_dir, exist_ok=True)
+
+    def sidecar_path(self, cf):
+        prefix = hashlib.sha1(os.path.abspath(cf).encode()).hexdigest()[:16]
+        return os.path.join(self.sidecar_dir, f"{prefix}_{os.path.basename(cf)}.{self.fmt}")
+
+    def source_metadata(self, cf, dtypes):
+        st = input_stat(cf)
+        return {b"source_size": str(st.st_size).encode(),
+                b"source_mtime_ns": str(st.st_mtime_ns).encode(),
+                b"header_start_row": str(self.skiprows).encode(),
+                b"dtypes": json.dumps(dtypes, sort_keys=True).encode()}
+
+    def read_schema(self, path):
+        if self.fmt == "parquet":
+            return pq.read_schema(path)
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema
+
+    def is_valid(self, cf, path, dtypes):
+        if not os.path.exists(path):
+            return False
+        try:
+            metadata = self.read_schema(path).metadata or dict()
+        except Exception as e:
+            self.logger.warning(f"Could not read sidecar {path}: {e}")
+            return False
+        return all(metadata.get(k) == v for k, v in self.source_metadata(cf, dtypes).items())
+
+    def transcode(self, cf, path, chunk_size, dtypes):
+        # dtypes of the header pre-scan, e.g. the time column as text, other columns are inferred
+        tmpfile = f"{path}.{os.getpid()}.tmp"
+        read_dtypes = dict(dtypes)
+        try:
+            while True:
+                try:
+                    self.write_chunks(cf, tmpfile, chunk_size, read_dtypes, self.source_metadata(cf, dtypes))
+                    break
+                except SchemaChange as e:
+                    self.logger.debug(f"Writing sidecar for {cf} again, {e}")
+                    read_dtypes.update(e.dtypes)
+            os.replace(tmpfile, path)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        self.logger.info(f"Written sidecar {path} for {cf}")
+
+    def write_chunks(self, cf, tmpfile, chunk_size, dtypes, metadata):
+        writer = None
+        schema = None
+        try:
+            with csv_source(cf) as source:
+                for df in pd.read_csv(source, skiprows=self.skiprows, dtype=dtypes, low_memory=False,
+                                      chunksize=chunk_size or TRANSCODE_CHUNK_SIZE):
+                    # object columns hold text mixed with missing values, store them as strings
+                    for col in df.select_dtypes(include="object").columns:
+                        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if writer is None:
+                        schema = table.schema.with_metadata({**(table.schema.metadata or dict()), **metadata})
+                        writer = self.open_writer(tmpfile, schema)
+                    writer.write_table(self.conform(df, table, schema))
+                if writer is None:
+                    raise ValueError(f"no rows in {cf}")
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def open_writer(self, tmpfile, schema):
+        if self.fmt == "parquet":
+            return pq.ParquetWriter(tmpfile, schema)
+        return pa.ipc.new_file(tmpfile, schema, options=pa.ipc.IpcWriteOptions(compression=None))
+
+    def conform(self, df, table, schema):
+        # table with the types of schema. Columns without values and integers in a float column are
+        # cast, other differences raise SchemaChange with the types of both
+        if table.schema.equals(schema):
+            return table
+        widened = dict()
+        columns = list()
+        for field in schema:
+            column = table.column(field.name)
+            if column.type != field.type:
+                if df[field.name].isna().all():
+                    column = pa.nulls(len(column), field.type)
+                elif pa.types.is_floating(field.type) and pa.types.is_integer(column.type):
+                    column = column.cast(field.type)
+                elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in [field.type, column.type]):
+                    widened[field.name] = "float64"
+                else:
+                    widened[field.name] = "str"
+            columns.append(column)
+        if widened:
+            raise SchemaChange(widened)
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    def read_batches(self, path, columns, chunk_size):
+        if self.fmt == "parquet":
+            pfile = pq.ParquetFile(path)
+            if not chunk_size:
+                yield pfile.read(columns=columns)
+                return
+            for batch in pfile.iter_batches(batch_size=chunk_size, columns=columns):
+                yield batch
+            return
+
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            if not chunk_size:
+                yield reader.read_all().select(columns)
+                return
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).select(columns)
+
+    def read_chunks(self, cf, load_columns, chunk_size, dtypes):
+        # returns None when there is no usable sidecar, the caller then reads the csv
+        if pa is None:
+            return None
+        path = self.sidecar_path(cf)
+        try:
+            if not self.is_valid(cf, path, dtypes):
+                self.transcode(cf, path, chunk_size, dtypes)
+            columns = [col for col in self.read_schema(path).names if col in load_columns]
+        except Exception as e:
+            self.logger.warning(f"Could not use sidecar for {cf}, reading csv instead: {e}")
+            return None
+        return self.iter_frames(path, columns, chunk_size)
+
+    def iter_frames(self, path, columns, chunk_size):
+        start = 0
+        for batch in self.read_batches(path, columns, chunk_size):
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(start, start + df.shape[0])
+            start += df.shape[0]
+            yield df
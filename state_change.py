@@ -0,0 +1,102 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+
+class StateChangeError(ValueError):
+    pass
+
+
+class StateChange(object):
+    # transitions of one column, between value_1 and value_2 in both directions or, with any_change,
+    # between any two different values
+
+    def __init__(self, column, value_1=None, value_2=None, any_change=False):
+        if not any_change and (value_1 is None or value_2 is None):
+            raise StateChangeError(f"State change for column {column} needs value_1 and value_2, or any_change")
+        self.column = column
+        self.value_1 = value_1
+        self.value_2 = value_2
+        self.any_change = any_change
+
+    def description(self):
+        if self.any_change:
+            return f"{self.column}: any change"
+        return f"{self.column}: {self.value_1} <-> {self.value_2}"
+
+    def column_values(self, series):
+        if not is_numeric_dtype(series.dtype):
+            return series.to_numpy(dtype=object), False
+        if series.dtype == bool:
+            # 0/1 columns stored as bool with memory_lean
+            return series.to_numpy().astype(np.int8), True
+        if isinstance(series.dtype, np.dtype):
+            return series.to_numpy(), True
+        # nullable extension dtypes
+        return series.to_numpy(dtype="float64", na_value=np.nan), True
+
+    def compare_value(self, value, numeric):
+        if numeric:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                pass
+        return value
+
+    def detect(self, series, in_range):
+        # returns the rows where the column changes state and the number of changes in in_range
+        # per (from, to) direction. The first row has no previous value and never changes state
+        values, numeric = self.column_values(series)
+        mask = np.zeros(values.shape[0], dtype=bool)
+        if values.shape[0] < 2:
+            return mask, dict()
+        previous, current = values[:-1], values[1:]
+
+        if self.any_change:
+            mask[1:] = (previous != current) & ~pd.isna(previous) & ~pd.isna(current)
+            hits = mask & in_range
+            counts = Counter(zip(values[np.flatnonzero(hits) - 1].tolist(), values[hits].tolist()))
+            return mask, dict(counts)
+
+        value_1 = self.compare_value(self.value_1, numeric)
+        value_2 = self.compare_value(self.value_2, numeric)
+        forward = np.zeros(values.shape[0], dtype=bool)
+        backward = np.zeros(values.shape[0], dtype=bool)
+        forward[1:] = (previous == value_1) & (current == value_2)
+        backward[1:] = (previous == value_2) & (current == value_1)
+        mask = forward | backward
+        return mask, {(self.value_1, self.value_2): int((forward & in_range).sum()),
+                      (self.value_2, self.value_1): int((backward & in_range).sum())}
+
+
+def compile_state_changes(config):
+    # state_change in the input json is a dictionary or a list of them with column_of_interest
+    # (one column or a list of columns) and either value_1 and value_2 or "any_change": true
+    if isinstance(config, dict):
+        config = [config]
+    if not isinstance(config, list):
+        raise StateChangeError(f"Invalid state_change {config}")
+
+    specs = list()
+    for entry in config:
+        if not isinstance(entry, dict):
+            raise StateChangeError(f"Invalid state_change {entry}")
+        columns = entry.get("column_of_interest", None)
+        if isinstance(columns, str):
+            columns = [columns]
+        for column in columns or list():
+            if column == "":
+                continue
+            specs.append(StateChange(column, entry.get("value_1", None), entry.get("value_2", None),
+                                     entry.get("any_change", False)))
+    return specs
+
+
+def merge_transitions(total, transitions):
+    # adds {column: {(from, to): count}} dictionaries
+    for column, counts in transitions.items():
+        column_total = total.setdefault(column, dict())
+        for direction, count in counts.items():
+            column_total[direction] = column_total.get(direction, 0) + count
+    return total
@@ -0,0 +1,87 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+# value written into analog tags on anomalous rows, thresholds are set between normal and anomalous values
+NORMAL_MEAN = 50.0
+NORMAL_STD = 5.0
+ANOMALY_VALUE = 150.0
+THRESHOLD_VALUE = 100.0
+
+
+class SyntheticTelemetry(object):
+    # PLC telemetry exports like the ones find_abnormality.py reads: 4 preamble lines, a header,
+    # "Local Computer Time" and float (analog) and int (on/off command) tag columns
+
+    def __init__(self, float_columns=200, int_columns=50, anomaly_rate=0.001, toggle_rate=0.01, seed=0):
+        self.float_columns = [f"AnaIn_DB.PT{i:03d}Pres.Output" for i in range(float_columns)]
+        self.int_columns = [f"AuxCoolSys_DB.AuxCoolSys.{i}.Fan.OnOffCmd" for i in range(int_columns)]
+        self.anomaly_rate = anomaly_rate
+        self.toggle_rate = toggle_rate
+        self.rng = np.random.default_rng(seed)
+
+    def columns(self):
+        return ["Local Computer Time"] + self.float_columns + self.int_columns
+
+    def block(self, start_time, start_row, nrows, state):
+        seconds = np.arange(start_row, start_row + nrows).astype("timedelta64[s]")
+        times = (np.datetime64(start_time, "s") + seconds).astype(str)
+        floats = self.rng.normal(NORMAL_MEAN, NORMAL_STD, size=(nrows, len(self.float_columns))).round(3)
+        floats[self.rng.random(floats.shape) < self.anomaly_rate] = ANOMALY_VALUE
+        # on/off commands flip with toggle_rate, continuing from the last row of the previous block
+        flips = self.rng.random((nrows, len(self.int_columns))) < self.toggle_rate
+        ints = (np.cumsum(flips, axis=0) + state) % 2
+        if nrows:
+            state[:] = ints[-1]
+        df = pd.DataFrame(floats, columns=self.float_columns)
+        df[self.int_columns] = ints.astype(np.int8)
+        df.insert(0, "Local Computer Time", times)
+        return df
+
+    def write_file(self, path, nrows, start_time, block_rows=100000):
+        state = np.zeros(len(self.int_columns), dtype=np.int64)
+        with open(path, "w", newline="") as f:
+            f.write(f"Synthetic telemetry export\nGenerated: {datetime.now()}\nRows: {nrows}\n\n")
+            for start_row in range(0, max(nrows, 1), block_rows):
+                df = self.block(start_time, start_row, min(block_rows, nrows - start_row), state)
+                df.to_csv(f, header=start_row == 0, index=False)
+        return os.path.getsize(path)
+
+    def write_dataset(self, outdir, files, rows_per_file, start_time=datetime(2024, 2, 27, 0, 0, 0)):
+        os.makedirs(outdir, exist_ok=True)
+        total_bytes = 0
+        for i in range(files):
+            file_start = start_time + timedelta(seconds=i * rows_per_file)
+            name = f"Data-GS100B000000001-{file_start.strftime('%y%m%d_%H.%M.%S')}.csv"
+            total_bytes += self.write_file(os.path.join(outdir, name), rows_per_file, file_start)
+        return total_bytes
+
+    def rule_config(self, threshold_columns=5, state_change_columns=5):
+        return {
+            "threshold": [{"column_of_interest": col, "value": THRESHOLD_VALUE, "operator": ">"}
+                          for col in self.float_columns[:threshold_columns]],
+            "state_change": {"column_of_interest": self.int_columns[:state_change_columns],
+                             "value_1": "0", "value_2": "1"},
+            "extra_columns": self.float_columns[threshold_columns:threshold_columns + 2],
+        }
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        """Generate synthetic PLC telemetry csv exports"""
+    )
+    args.add_argument("-o", "--output-directory", required=True, help="Directory to write csv files to")
+    args.add_argument("-f", "--files", type=int, default=1, help="Number of files")
+    args.add_argument("-r", "--rows", type=int, default=10000, help="Rows per file")
+    args.add_argument("--float-columns", type=int, default=200, help="Number of float tag columns")
+    args.add_argument("--int-columns", type=int, default=50, help="Number of on/off command columns")
+    args.add_argument("--anomaly-rate", type=float, default=0.001, help="Fraction of float values above threshold")
+    args.add_argument("--toggle-rate", type=float, default=0.01, help="Probability of an on/off command changing per row")
+    args.add_argument("--seed", type=int, default=0, help="Random seed")
+    pargs = args.parse_args()
+
+    generator = SyntheticTelemetry(pargs.float_columns, pargs.int_columns, pargs.anomaly_rate, pargs.toggle_rate, pargs.seed)
+    nbytes = generator.write_dataset(pargs.output_directory, pargs.files, pargs.rows)
+    print(f"Written {pargs.files} files, {nbytes/1e6:.1f} MB to {pargs.output_directory}")
@@ -0,0 +1,218 @@
+import io
+import os
+import csv
+import json
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from compressed_input import is_compressed
+
+# bytes read from the start and the end of a file when it is indexed
+SAMPLE_BYTES = 65536
+
+
+class ByteRange(io.RawIOBase):
+    # the bytes of an open binary file between two offsets, read like a file of their own
+
+    def __init__(self, f, start, end):
+        super().__init__()
+        f.seek(start)
+        self.f = f
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        size = self.f.readinto(memoryview(buffer)[:size])
+        self.remaining -= size
+        return size
+
+
+class TimeIndex(object):
+    # Persistent index of the first and last "Local Computer Time" of each csv, kept in a json file.
+    # Entries are built from the head and the tail of a file only, and again when its size or
+    # modification time changes. The row count is estimated from the average length of the lines
+    # at the head of the file, it is exact for files shorter than SAMPLE_BYTES. Compressed files
+    # cannot be sampled at their end or read from an offset, they are not indexed and read whole.
+
+    def __init__(self, index_file, read_header, time_column="Local Computer Time", workers=8):
+        self.logger = logging.getLogger('common')
+        self.index_file = index_file
+        self.read_header = read_header
+        self.time_column = time_column
+        self.workers = max(workers, 1)
+        self.entries = dict()
+        self.dirty = False
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Could not read time index {index_file}, building it again: {e}")
+
+    def save(self):
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.index_file))
+        os.makedirs(dirname, exist_ok=True)
+        tmpfile = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmpfile, self.index_file)
+        self.dirty = False
+
+    def parse_time(self, value):
+        try:
+            tstamp = pd.to_datetime(value)
+        except (ValueError, TypeError, OverflowError):
+            return None
+        if pd.isna(tstamp):
+            return None
+        if tstamp.tzinfo is not None:
+            tstamp = tstamp.tz_localize(None)
+        return tstamp.to_pydatetime()
+
+    def line_time(self, line, column):
+        fields = next(csv.reader([line.decode("utf-8", errors="replace")]), list())
+        if column >= len(fields):
+            return None
+        return self.parse_time(fields[column])
+
+    def build(self, cf, st):
+        skipped, header = self.read_header(cf)
+        if self.time_column not in header:
+            return None
+        column = header.index(self.time_column)
+        with open(cf, "rb") as f:
+            for _ in range(skipped + 1):
+                f.readline()
+            data_start = f.tell()
+            head = f.read(SAMPLE_BYTES)
+            f.seek(max(data_start, st.st_size - SAMPLE_BYTES))
+            tail = f.read()
+
+        head_lines = [x for x in head.split(b"\n") if x.strip()]
+        complete = len(head) < SAMPLE_BYTES
+        if not complete:
+            # the last line of the sample may be cut
+            head_lines = head_lines[:-1]
+        first = self.line_time(head_lines[0], column) if head_lines else None
+
+        last = None
+        tail_lines = [x for x in tail.split(b"\n") if x.strip()]
+        if st.st_size - SAMPLE_BYTES > data_start:
+            tail_lines = tail_lines[1:]
+        # a file still being written may end in a partial line
+        for line in reversed(tail_lines):
+            last = self.line_time(line, column)
+            if last is not None:
+                break
+
+        if complete:
+            rows = len(head_lines)
+        else:
+            sampled = head.rfind(b"\n") + 1
+            rows = int(round((st.st_size - data_start) * len(head_lines) / sampled)) if sampled else 0
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "data_start": data_start,
+                "time_column": column,
+                "first": first.isoformat() if first else None,
+                "last": last.isoformat() if last else None,
+                "rows": rows}
+
+    def entry(self, cf):
+        # returns the index entry of cf, built when missing or stale, None when the file has no time column
+        key = os.path.abspath(cf)
+        if is_compressed(cf):
+            return None
+        try:
+            st = os.stat(cf)
+        except OSError as e:
+            self.logger.warning(f"Could not index {cf}: {e}")
+            return None
+        entry = self.entries.get(key, None)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry
+        try:
+            entry = self.build(cf, st)
+        except Exception as e:
+            self.logger.warning(f"Could not index {cf}: {e}")
+            return None
+        self.entries[key] = entry
+        self.dirty = True
+        return entry
+
+    def update(self, files):
+        # entries of the files, new and modified files are indexed over a thread pool
+        if self.workers <= 1 or len(files) < 2:
+            entries = [self.entry(cf) for cf in files]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                entries = list(executor.map(self.entry, files))
+        self.save()
+        return entries
+
+    def time_range(self, entry):
+        if not entry or entry["first"] is None or entry["last"] is None:
+            return None, None
+        return datetime.fromisoformat(entry["first"]), datetime.fromisoformat(entry["last"])
+
+    def filter_files(self, files, start, end):
+        # keeps the files with rows between start and end, and those the index has no times for
+        kept = list()
+        for cf, entry in zip(files, self.update(files)):
+            first, last = self.time_range(entry)
+            if first is not None and first <= last and (last < start or first > end):
+                self.logger.debug(f"{cf} has rows from {first} to {last}, outside {start} - {end}. Discard this file")
+                continue
+            kept.append(cf)
+        self.logger.info(f"{len(kept)} of {len(files)} files have rows between {start} and {end}")
+        return kept
+
+    def line_at(self, f, offset, lo, column):
+        # start, end and time of the first line starting at or after offset, lo is a line start
+        if offset > lo:
+            f.seek(offset - 1)
+            f.readline()
+        else:
+            f.seek(offset)
+        start = f.tell()
+        line = f.readline()
+        return start, f.tell(), self.line_time(line, column) if line.strip() else None
+
+    def seek_time(self, f, lo, hi, column, target, strict):
+        # first line start in [lo, hi) with a time >= target (> target when strict), hi when there is none.
+        # The times must increase through the file.
+        found = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end, tstamp = self.line_at(f, mid, lo, column)
+            if start >= hi:
+                hi = mid
+                continue
+            if tstamp is not None and (tstamp > target if strict else tstamp >= target):
+                found = start
+                hi = start
+            else:
+                lo = end
+        return found
+
+    def byte_range(self, cf, start, end):
+        # Byte offsets of the rows of cf between start and end. None when all rows are in the range
+        # or when they cannot be located: the file is not indexed or its times do not increase.
+        entry = self.entry(cf)
+        first, last = self.time_range(entry)
+        if first is None or first > last:
+            return None
+        if start <= first and last <= end:
+            return None
+        size = entry["size"]
+        with open(cf, "rb") as f:
+            begin = self.seek_time(f, entry["data_start"], size, entry["time_column"], start, False)
+            stop = self.seek_time(f, begin, size, entry["time_column"], end, True)
+        return begin, stop